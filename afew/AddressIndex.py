@@ -0,0 +1,120 @@
+# SPDX-License-Identifier: ISC
+
+"""
+Sets of mail addresses, and parsing of address headers.
+"""
+
+import functools
+import re
+from email.utils import getaddresses
+
+from afew.NotmuchSettings import notmuch_settings
+
+# the common forms of address list items: `Name <addr>`, `"Name" <addr>` and
+# `addr`; anything else (groups, comments, ...) is left to the email package,
+# which is a lot slower
+_ADDR_SPEC = r'[^\s<>()\[\]\\,;:@"]+@[^\s<>()\[\]\\,;:@"]+'
+_SIMPLE_ITEM = r'\s*(?:(?:"[^"\\]*(?:\\.[^"\\]*)*"\s*|[^"<>()\[\]\\,;:@]*)<(%s)>|(%s))\s*' % (
+    _ADDR_SPEC, _ADDR_SPEC)
+_simple_list_re = re.compile(r'%s(?:,%s)*' % (_SIMPLE_ITEM, _SIMPLE_ITEM))
+_simple_item_re = re.compile(_SIMPLE_ITEM)
+
+
+def normalize_address(address):
+    """
+    Returns the form of an address used for comparing it to others.
+    """
+    return address.strip().casefold()
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_addresses(value):
+    """
+    Returns the normalized addresses in the value of an address list header
+    like `To`, as a tuple.  Mails sent to a group of people repeat the same
+    header values a lot, so they are parsed only once.
+    """
+    if _simple_list_re.fullmatch(value):
+        return tuple(bracketed or bare
+                     for bracketed, bare in _simple_item_re.findall(value.casefold()))
+    return tuple(normalize_address(address) for name, address in getaddresses([value])
+                 if '@' in address)
+
+
+class AddressIndex:
+    """
+    A set of addresses, e.g. the user's own ones, compared after
+    normalization.
+
+    :param addresses: the addresses
+    :type  addresses: iterable of str
+    """
+
+    def __init__(self, addresses):
+        self.addresses = frozenset(normalize_address(address) for address in addresses
+                                   if address.strip())
+
+    @classmethod
+    def mine(cls):
+        """
+        Returns the index of the user's addresses, `primary_email` and
+        `other_email` in the notmuch config.
+        """
+        addresses = [notmuch_settings.get('user', 'primary_email')]
+        if notmuch_settings.has_option('user', 'other_email'):
+            addresses.extend(notmuch_settings.get_list('user', 'other_email'))
+        return cls(addresses)
+
+    def __contains__(self, address):
+        return normalize_address(address) in self.addresses
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def any_in(self, value):
+        """
+        Returns whether any address in the value of an address list header is
+        in the index.
+        """
+        return not self.addresses.isdisjoint(parse_addresses(value))
+
+    def queries(self, prefix, batch_size=0):
+        """
+        Returns notmuch queries for the messages with any of the addresses in
+        the header searched by `prefix`, e.g. ``from``.
+
+        :param batch_size: the number of addresses per query, all of them go
+                           into one query if 0
+        :type  batch_size: int
+        :rtype: list of str
+        """
+        addresses = sorted(self.addresses)
+        batch_size = batch_size or len(addresses) or 1
+        return [' OR '.join('%s:"%s"' % (prefix, address.replace('"', '""'))
+                            for address in addresses[start:start + batch_size])
+                for start in range(0, len(addresses), batch_size)]
+
+    def query(self, prefix):
+        """
+        Returns a single notmuch query for the messages with any of the
+        addresses in the header searched by `prefix`.
+        """
+        queries = self.queries(prefix)
+        return queries[0] if queries else ''
+
+    def message_ids(self, database, prefix, query='', batch_size=0):
+        """
+        Returns the ids of the messages matching `query` with any of the
+        addresses in the header searched by `prefix`, running one query per
+        batch of addresses and joining the results.
+
+        :type  database: :class:`afew.Database.Database`
+        :rtype: set
+        """
+        message_ids = set()
+        for address_query in self.queries(prefix, batch_size):
+            if query:
+                address_query = '(%s) AND (%s)' % (query, address_query)
+            message_ids.update(message.messageid for message
+                               in database.get_messages(address_query))
+        return message_ids
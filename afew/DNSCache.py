@@ -0,0 +1,148 @@
+# SPDX-License-Identifier: ISC
+
+"""
+Cache for the DNS TXT records dkimpy looks up to verify DKIM signatures.
+"""
+
+import base64
+import collections
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import dkim
+import dns.exception
+import dns.rdatatype
+import dns.resolver
+
+
+class DNSCache:
+    """
+    Caches TXT records for their TTL, keeping at most `max_entries` of them
+    and evicting the least recently used ones first.
+
+    :meth:`get_txt` can be passed to :func:`dkim.verify` as `dnsfunc`.
+
+    :param path: file to persist the cache in between runs, `None` to keep it
+                 in memory only
+    :type  path: str
+    :param max_entries: maximum number of cached records
+    :type  max_entries: int
+    :param offline: answer from expired entries when DNS lookups fail
+    :type  offline: bool
+    :param negative_ttl: seconds to remember that a name has no TXT record
+    :type  negative_ttl: int
+    """
+
+    def __init__(self, path=None, max_entries=1000, offline=False, negative_ttl=300):
+        self.path = path
+        self.max_entries = max_entries
+        self.offline = offline
+        self.negative_ttl = negative_ttl
+        self.log = logging.getLogger('{}.{}'.format(
+            self.__module__, self.__class__.__name__))
+        self._entries = None
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        self._entries = collections.OrderedDict()
+        if not self.path:
+            return
+        entries = collections.OrderedDict()
+        try:
+            with open(self.path) as cache_file:
+                rows = json.load(cache_file)
+            for name, value, expires in rows[-self.max_entries:]:
+                if value is not None:
+                    value = base64.b64decode(value, validate=True)
+                entries[name] = (value, float(expires))
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, TypeError) as error:
+            # not written by us, or damaged
+            self.log.warning('Ignoring unreadable DNS cache {!r}: {}'.format(self.path, error))
+            return
+        self._entries = entries
+
+    def save(self):
+        """
+        Writes the cache to its file, if anything changed.
+        """
+        with self._lock:
+            if not self.path or not self._dirty:
+                return
+            entries = [(name,
+                        None if value is None else base64.b64encode(value).decode('ascii'),
+                        expires)
+                       for name, (value, expires) in self._entries.items()]
+            self._dirty = False
+
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as cache_file:
+            json.dump(entries, cache_file)
+        os.replace(cache_file.name, self.path)
+
+    def _get(self, name):
+        with self._lock:
+            if self._entries is None:
+                self._load()
+            entry = self._entries.get(name)
+            if entry is not None:
+                self._entries.move_to_end(name)
+            return entry
+
+    def _put(self, name, value, ttl):
+        with self._lock:
+            self._entries[name] = (value, time.time() + ttl)
+            self._entries.move_to_end(name)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._dirty = True
+
+    def _resolve(self, name, timeout):
+        """
+        Looks up a TXT record, returns the record (or `None`) and its TTL.
+        """
+        try:
+            answer = dns.resolver.resolve(name, dns.rdatatype.TXT, raise_on_no_answer=False,
+                                          lifetime=timeout, search=True)
+        except dns.resolver.NXDOMAIN:
+            return None, self.negative_ttl
+        for rrset in answer.response.answer:
+            if rrset.rdtype == dns.rdatatype.TXT:
+                return b''.join(list(rrset.items)[0].strings), rrset.ttl
+        return None, self.negative_ttl
+
+    def get_txt(self, name, timeout=5):
+        """
+        Returns the TXT record of a DNS name, like :func:`dkim.dnsplug.get_txt`.
+
+        :param name: the name to look up
+        :type  name: bytes
+        :raises: :class:`dkim.DnsTimeoutError` if the lookup fails and there
+                 is no usable cache entry
+        """
+        try:
+            key = name.decode('UTF-8')
+        except UnicodeDecodeError:
+            return None
+
+        entry = self._get(key)
+        if entry is not None and entry[1] > time.time():
+            return entry[0]
+
+        try:
+            value, ttl = self._resolve(key, timeout)
+        except dns.exception.DNSException as error:
+            if self.offline and entry is not None:
+                self.log.info('DNS lookup of {} failed, using expired cache entry: {}'.format(key, error))
+                return entry[0]
+            raise dkim.DnsTimeoutError('{}: {}'.format(type(error).__name__, error)) from error
+
+        self._put(key, value, ttl)
+        return value
@@ -1,7 +1,9 @@
 # SPDX-License-Identifier: ISC
 # Copyright (c) Justus Winter <4winter@informatik.uni-hamburg.de>
 
+import collections
 import os
+import random
 import time
 import logging
 
@@ -10,14 +12,32 @@ import notmuch2
 from afew.NotmuchSettings import notmuch_settings, get_notmuch_new_tags
 
 
+class AddedMessage(collections.namedtuple('AddedMessage', ('path', 'status', 'message', 'error'))):
+    """
+    The outcome of adding a file with :func:`Database.add_messages`.
+    """
+    __slots__ = ()
+
+    NEW = 'new'
+    DUPLICATE = 'duplicate'
+    ERROR = 'error'
+
+
 class Database:
     """
     Convenience wrapper around `notmuch`.
+
+    :param commit_batch_size: number of messages whose tags are changed
+                              in one atomic section by
+                              :func:`Database.apply_tag_changes`, 0 means
+                              all of them
+    :type  commit_batch_size: int
     """
 
-    def __init__(self):
+    def __init__(self, commit_batch_size=0):
         self.db_path = self._calculate_db_path()
         self.handle = None
+        self.commit_batch_size = commit_batch_size
 
     def _calculate_db_path(self):
         """
@@ -46,28 +66,40 @@ class Database:
         """
         self.close()
 
-    def open(self, rw=False, retry_for=180, retry_delay=1):
+    def open(self, rw=False, retry_for=180, retry_delay=0.05, max_retry_delay=5):
+        """
+        Opens the notmuch database, or returns the handle that is already open.
+
+        Opening it read-write fails while another process holds the write
+        lock.  It is then retried for up to `retry_for` seconds, waiting
+        `retry_delay` seconds at first and twice as long after every failed
+        attempt (at most `max_retry_delay`), with random jitter so that
+        competing processes do not retry in lockstep.
+        """
         if rw:
             if self.handle and self.handle.mode == notmuch2.Database.MODE.READ_WRITE:
                 return self.handle
 
-            start_time = time.time()
+            start_time = time.monotonic()
+            delay = retry_delay
             while True:
                 try:
                     self.handle = notmuch2.Database(self.db_path,
                                                     mode=notmuch2.Database.MODE.READ_WRITE)
                     break
                 except notmuch2.NotmuchError:
-                    time_left = int(retry_for - (time.time() - start_time))
+                    time_left = retry_for - (time.monotonic() - start_time)
 
                     if time_left <= 0:
                         raise
 
-                    if time_left % 15 == 0:
-                        logging.debug(
-                            'Opening the database failed. Will keep trying for another {} seconds'.format(time_left))
+                    sleep = min(time_left, random.uniform(delay / 2, delay))
+                    logging.debug(
+                        'Opening the database failed. Retrying in {:.2f} seconds, '
+                        'will keep trying for another {:.0f} seconds'.format(sleep, time_left))
 
-                    time.sleep(retry_delay)
+                    time.sleep(sleep)
+                    delay = min(delay * 2, max_retry_delay)
         else:
             if not self.handle:
                 self.handle = notmuch2.Database(self.db_path,
@@ -145,6 +177,98 @@ class Database:
             for message in self.walk_replies(message):
                 yield message
 
+    def apply_tag_changes(self, changes):
+        """
+        Writes tag changes to the database.
+
+        The changes are made inside atomic sections of at most
+        `commit_batch_size` messages.  Each message is frozen while its tags
+        are updated, so it is written only once, and messages whose tags are
+        already in the desired state are not written at all.
+
+        :param changes: maps message ids to ``(flush, tags_to_add,
+                        tags_to_remove)`` tuples, applied in that order
+        :type  changes: dict
+        """
+        if not changes:
+            return
+
+        db = self.open(rw=True)
+        message_ids = list(changes)
+        batch_size = self.commit_batch_size or len(message_ids)
+
+        for start in range(0, len(message_ids), batch_size):
+            with db.atomic():
+                for message_id in message_ids[start:start + batch_size]:
+                    try:
+                        message = db.find(message_id)
+                    except LookupError:
+                        logging.warning('Message {} vanished before its tags could be changed'.format(message_id))
+                        continue
+
+                    flush, tags_to_add, tags_to_remove = changes[message_id]
+                    current = set(message.tags)
+                    wanted = (set() if flush else set(current))
+                    wanted.update(tags_to_add)
+                    wanted.difference_update(tags_to_remove)
+                    if wanted == current:
+                        continue
+
+                    with message.frozen():
+                        for tag in current - wanted:
+                            message.tags.discard(tag)
+                        for tag in wanted - current:
+                            message.tags.add(tag)
+
+    def add_messages(self, paths, sync_maildir_flags=False):
+        """
+        Adds the given messages to the notmuch index, in one atomic section.
+
+        New messages get the tags notmuch gives to new mail, then the
+        maildir flags are synced, so they override the new mail tags.  The
+        tags of each message are changed in one update.
+
+        :param paths: paths to the messages
+        :type  paths: iterable of str
+        :param sync_maildir_flags: if `True` notmuch converts the
+                                   standard maildir flags to tags
+        :type  sync_maildir_flags: bool
+        :raises: :class:`notmuch.NotmuchError` if the database fails
+        :returns: an :class:`AddedMessage` for each path, in order; files
+                  that cannot be added are reported with the `error` status
+                  and the exception
+        :rtype:   list
+        """
+        handle = self.open(rw=True)
+        new_tags = list(get_notmuch_new_tags())
+        results = []
+
+        with handle.atomic():
+            for path in paths:
+                try:
+                    message, duplicate = handle.add(path)
+                except (notmuch2.FileError, notmuch2.FileNotEmailError) as e:
+                    results.append(AddedMessage(path, AddedMessage.ERROR, None, e))
+                    continue
+
+                if duplicate:
+                    results.append(AddedMessage(path, AddedMessage.DUPLICATE, message, None))
+                else:
+                    logging.info('Found new mail in {}'.format(path))
+                    results.append(AddedMessage(path, AddedMessage.NEW, message, None))
+
+                if sync_maildir_flags or not duplicate:
+                    with message.frozen():
+                        if not duplicate:
+                            for tag in new_tags:
+                                message.tags.add(tag)
+                        # last, like notmuch new does, so that e.g. the S
+                        # flag removes `unread`
+                        if sync_maildir_flags:
+                            message.tags.from_maildir_flags()
+
+        return results
+
     def add_message(self, path, sync_maildir_flags=False, new_mail_handler=None):
         """
         Adds the given message to the notmuch index.
@@ -162,20 +286,65 @@ class Database:
         :returns: a :class:`notmuch.Message` object
         """
         # TODO: it would be nice to update notmuchs directory index here
-        handle = self.open(rw=True)
-        message, duplicate = handle.add(path, sync_flags=sync_maildir_flags)
+        result, = self.add_messages([path], sync_maildir_flags=sync_maildir_flags)
+        if result.error is not None:
+            raise result.error
 
-        if not duplicate:
-            logging.info('Found new mail in {}'.format(path))
+        if result.status == AddedMessage.NEW and new_mail_handler:
+            new_mail_handler(result.message)
 
-            for tag in get_notmuch_new_tags():
-                message.tags.add(tag)
-
-            if new_mail_handler:
-                new_mail_handler(message)
+        return result.message
 
+    def rename_message(self, old_path, new_path):
+        """
+        Updates the index after a message file has been renamed, and syncs
+        the tags with the maildir flags of the new filename.
+
+        Unlike :func:`Database.add_message`, this never treats the message
+        as new mail.
+
+        :param old_path: the path the message was indexed under
+        :type  old_path: str
+        :param new_path: the path of the message now
+        :type  new_path: str
+        :raises: :class:`notmuch.NotmuchError` if adding the new path fails
+        :returns: the renamed :class:`notmuch.Message`, or `None` if no
+                  message was indexed under `old_path` (nothing is changed
+                  then)
+        """
+        handle = self.open(rw=True)
+        try:
+            handle.get(old_path)
+        except LookupError:
+            return None
+
+        with handle.atomic():
+            if old_path != new_path:
+                handle.add(new_path)
+                handle.remove(old_path)
+            # look up again, so that only the new filename is considered
+            message = handle.get(new_path)
+            message.tags.from_maildir_flags()
         return message
 
+    def move_messages(self, moves):
+        """
+        Updates the index after message files have been moved, in one
+        atomic section.
+
+        :param moves: ``(old_path, new_paths)`` pairs; each new path is
+                      added as a filename of its message, and the old path
+                      is removed
+        :type  moves: iterable
+        :raises: :class:`notmuch.NotmuchError` if updating the index fails
+        """
+        handle = self.open(rw=True)
+        with handle.atomic():
+            for old_path, new_paths in moves:
+                for new_path in new_paths:
+                    handle.add(new_path)
+                handle.remove(old_path)
+
     def remove_message(self, path):
         """
         Remove the given message from the notmuch index.
@@ -183,4 +352,4 @@ class Database:
         :param path: path to the message
         :type  path: str
         """
-        self.open(rw=True).remove_message(path)
+        self.open(rw=True).remove(path)
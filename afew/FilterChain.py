@@ -0,0 +1,205 @@
+# SPDX-License-Identifier: ISC
+
+import logging
+
+from afew.filters.BaseFilter import Filter
+from afew.filters.HeaderMatchingFilter import HeaderMatchingGroup
+from afew.MessageView import MessageView
+from afew.QueryMatcher import QueryMatcher
+from afew.ThreadIndex import ThreadIndex
+
+
+class TagChanges:
+    """
+    The tag changes collected for a single message.
+
+    Changes are recorded in the order the filters requested them, so the
+    outcome is the same as if every filter had committed its own changes
+    before the next one ran.
+    """
+
+    def __init__(self):
+        self.flush = False
+        self.add = set()
+        self.remove = set()
+
+    def __bool__(self):
+        return bool(self.flush or self.add or self.remove)
+
+    def update(self, flush, add, remove):
+        """
+        Records the changes of one filter, in the order :meth:`Filter.commit`
+        would apply them: flush, add, remove.
+        """
+        if flush:
+            self.flush = True
+            self.add.clear()
+            self.remove.clear()
+        self.add.update(add)
+        self.remove.difference_update(add)
+        self.remove.update(remove)
+        self.add.difference_update(remove)
+
+    def apply(self, tags):
+        """
+        Returns the given tag set with the changes applied.
+        """
+        if self.flush:
+            return set(self.add)
+        return (set(tags) | self.add) - self.remove
+
+
+class FilterChain:
+    """
+    Runs a sequence of filters over the messages matching a query in a single
+    pass.
+
+    Each message is loaded once and handed to every filter whose query it
+    matches, in order.  Tag changes are collected in memory, so later filters
+    see what earlier filters did to a message (both in `message.tags` and when
+    deciding whether their query matches), and are written by :meth:`commit`.
+    The filters share one :class:`afew.ThreadIndex.ThreadIndex`, which also
+    reflects the pending changes.  Header matching filters are evaluated
+    together by a :class:`afew.filters.HeaderMatchingFilter.HeaderMatchingGroup`,
+    which reads each header of a message only once.  Changes a filter only makes in
+    :meth:`Filter.finish` are not seen by the other filters of the pass.
+
+    A filter that looks at other messages than the one it is handling, i.e.
+    at threads (`uses_thread_index`), must see all changes of the filters
+    before it, and none of the ones after it, like with separate commits.  It
+    gets a pass of its own, which starts after the previous pass is finished.
+
+    Filters that override :meth:`Filter.run` can not take part in a pass
+    either.  They are run on their own at their position in the chain, after
+    the changes collected so far have been written to the database, unless
+    this is a dry run; then they do not see these changes.
+    """
+
+    def __init__(self, database, filters):
+        self.database = database
+        self.filters = list(filters)
+        self.log = logging.getLogger('{}.{}'.format(
+            self.__module__, self.__class__.__name__))
+        self.flush_changes()
+
+    def flush_changes(self):
+        '''
+        (Re)Initializes the changes collected from the filters.
+        '''
+        self._changes = {}
+
+    def _stages(self):
+        '''
+        Groups the filters into runs of filters that can share a pass.
+        '''
+        stage = []
+        for filter_ in self.filters:
+            if type(filter_).run is Filter.run and not filter_.uses_thread_index:
+                stage.append(filter_)
+            else:
+                if stage:
+                    yield stage
+                    stage = []
+                yield [filter_]
+        if stage:
+            yield stage
+
+    def run(self, query, dry_run=True):
+        '''
+        Runs the filters over the messages matching the query.
+
+        :param dry_run: whether :meth:`commit` will be called with `dry_run`;
+                        if not, changes are written early for filters that
+                        override :meth:`Filter.run`
+        :type  dry_run: bool
+        '''
+        self._share_thread_index()
+        for stage in self._stages():
+            if len(stage) == 1 and type(stage[0]).run is not Filter.run:
+                if any(self._changes.values()):
+                    if dry_run:
+                        self.log.warning('{} does not see the changes of the filters before it '
+                                         'in a dry run'.format(type(stage[0]).__name__))
+                    else:
+                        self.commit(dry_run=False)
+                        self._share_thread_index()
+                stage[0].run(query)
+                self._collect(stage[0])
+            else:
+                self._run_pass(stage, query)
+
+    def _share_thread_index(self):
+        self.thread_index = ThreadIndex(self.database, self._changes)
+        for filter_ in self.filters:
+            filter_.thread_index = self.thread_index
+
+    def _union_query(self, query, filters):
+        filter_queries = [getattr(filter_, 'query', None) for filter_ in filters]
+        if not all(filter_queries):
+            return query
+
+        union = ' OR '.join('(%s)' % filter_query for filter_query in filter_queries)
+        if query:
+            return '(%s) AND (%s)' % (query, union)
+        return union
+
+    def _run_pass(self, filters, query):
+        union = self._union_query(query, filters)
+        matching_ids = {}
+
+        def lookup(subquery):
+            if subquery not in matching_ids:
+                if union:
+                    subquery_in_pass = '(%s) AND (%s)' % (union, subquery)
+                else:
+                    subquery_in_pass = subquery
+                matching_ids[subquery] = set(message.messageid for message
+                                             in self.database.get_messages(subquery_in_pass))
+            return matching_ids[subquery]
+
+        matchers = [QueryMatcher(filter_.build_query(query), lookup)
+                    for filter_ in filters]
+        header_group = HeaderMatchingGroup(filters)
+        for filter_ in filters:
+            filter_.log.info(filter_.message)
+        if any(filter_.prefetch_threads for filter_ in filters):
+            self.thread_index.prefetch(union)
+
+        for message in self.database.get_messages(union):
+            view = MessageView(message, self._changes)
+            header_group.start(view)
+            for filter_, matcher in zip(filters, matchers):
+                if matcher.matches(view):
+                    if filter_ in header_group:
+                        header_group.handle_message(filter_, view)
+                    else:
+                        filter_.handle_message(view)
+                    self._collect(filter_)
+
+        for filter_ in filters:
+            filter_.finish()
+            self._collect(filter_)
+
+    def _collect(self, filter_):
+        '''
+        Moves the changes enqueued by a filter into the chain.
+        '''
+        for message_id, changes in filter_.get_changes().items():
+            self._changes.setdefault(message_id, TagChanges()).update(*changes)
+        filter_.flush_changes()
+
+    def commit(self, dry_run=True):
+        changes = dict((message_id, (changes.flush, changes.add, changes.remove))
+                       for message_id, changes in self._changes.items()
+                       if changes)
+
+        if not changes:
+            return
+
+        if dry_run:
+            self.log.info('I would commit changes to %i messages' % len(changes))
+        else:
+            self.log.info('Committing changes to %i messages' % len(changes))
+            self.database.apply_tag_changes(changes)
+
+        self.flush_changes()
@@ -1,36 +1,164 @@
 # SPDX-License-Identifier: ISC
 # Copyright (c) dtk <dtk@gmx.de>
 
+import collections
+import concurrent.futures
+import contextlib
+import errno
+import json
 import logging
 import os
 import shutil
+import threading
 import uuid
 from datetime import date, datetime, timedelta
 from subprocess import check_call, CalledProcessError, DEVNULL
 
+import notmuch2
+
 from afew.Database import Database
+from afew.MessageView import MessageView
+from afew.MoveJournal import MoveJournal
+from afew.QueryMatcher import QueryMatcher
+from afew.Settings import user_state_dir
 from afew.utils import get_message_summary
 
+Move = collections.namedtuple('Move', ('message_id', 'source', 'destination', 'folder', 'query'))
+MoveResult = collections.namedtuple('MoveResult', ('source', 'destinations', 'error'))
+
+
+def write_plan(moves, plan_file):
+    """
+    Writes planned moves to a file, as one JSON object per line with the
+    keys `message_id`, `source`, `destination`, `folder` and `rule`.
+
+    :param moves: the planned moves
+    :type  moves: list of :class:`Move`
+    :param plan_file: a file opened for writing text
+    """
+    for move in moves:
+        plan_file.write(json.dumps(collections.OrderedDict((
+            ('message_id', move.message_id),
+            ('source', move.source),
+            ('destination', move.destination),
+            ('folder', move.folder),
+            ('rule', move.query),
+        ))) + '\n')
+
+
+def read_plan(plan_file):
+    """
+    Reads moves written by :func:`write_plan`.
+
+    :param plan_file: a file opened for reading text
+    :returns: the planned moves
+    :rtype:   list of :class:`Move`
+    :raises: :class:`ValueError` if a line is not a planned move
+    """
+    moves = []
+    for number, line in enumerate(plan_file, 1):
+        if not line.strip():
+            continue
+        try:
+            entry = json.loads(line)
+            moves.append(Move(entry['message_id'], entry['source'], entry['destination'],
+                              entry.get('folder', ''), entry.get('rule', '')))
+        except (ValueError, TypeError, KeyError) as err:
+            raise ValueError('line {} of the move plan is not a planned move: {}'.format(
+                number, err)) from err
+    return moves
+
+
+def _fsync(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def copy_file(source, destination):
+    """
+    Copies a file and makes sure the copy is on disk.
+    """
+    shutil.copy2(source, destination)
+    _fsync(destination)
+    _fsync(os.path.dirname(destination))
+
+
+def move_file(source, destinations):
+    """
+    Moves a file to one or more destinations.
+
+    The file is renamed to the last destination, which is atomic if both are
+    on the same file system; otherwise it is copied there before the source
+    is removed.  The other destinations get copies.
+
+    :param source: the file to move
+    :type  source: str
+    :param destinations: the paths to move it to, which must not exist
+    :type  destinations: list of str
+    :raises: :class:`OSError` if the file could not be moved; the copies made
+             so far are removed again
+    """
+    created = []
+    try:
+        for destination in destinations[:-1]:
+            created.append(destination)
+            copy_file(source, destination)
+        try:
+            os.rename(source, destinations[-1])
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            created.append(destinations[-1])
+            copy_file(source, destinations[-1])
+            os.remove(source)
+    except OSError:
+        for destination in created:
+            try:
+                os.remove(destination)
+            except FileNotFoundError:
+                pass
+        raise
+
 
 class MailMover(Database):
     """
     Move mail files matching a given notmuch query into a target maildir folder.
+
+    All folders and their rules are handled together: the moves are planned
+    with one query for all of them, carried out in one pass, and recorded in
+    the index in one go.
+
+    With more than one worker, files are moved by a pool of threads, with at
+    most `workers_per_destination` of them moving files into the same
+    directory at a time (0 for no limit).
+
+    The moves are recorded in the notmuch index directly, unless
+    `use_notmuch_new` is set or that fails; then `notmuch new` is run to
+    pick them up.
     """
 
-    def __init__(self, max_age=0, rename=False, dry_run=False, notmuch_args='', quiet=False):
+    def __init__(self, max_age=0, rename=False, dry_run=False, notmuch_args='', quiet=False,
+                 journal_path=None, use_notmuch_new=False, workers=1, workers_per_destination=0):
         super().__init__()
         self.db = Database()
-        self.query = 'folder:"{folder}" AND {subquery}'
+        self.journal = MoveJournal(journal_path or os.path.join(user_state_dir, 'mailmover-journal'))
+        self.age_query = ''
         if max_age:
             days = timedelta(int(max_age))
             start = date.today() - days
             now = datetime.now()
-            self.query += ' AND {start}..{now}'.format(start=start.strftime('%s'),
-                                                       now=now.strftime('%s'))
+            self.age_query = ' AND {start}..{now}'.format(start=start.strftime('%s'),
+                                                          now=now.strftime('%s'))
         self.dry_run = dry_run
         self.rename = rename
         self.notmuch_args = notmuch_args
         self.quiet = quiet
+        self.use_notmuch_new = use_notmuch_new
+        self.workers = workers
+        self.workers_per_destination = workers_per_destination
 
     def get_new_name(self, fname, destination):
         basename = os.path.basename(fname)
@@ -46,64 +174,240 @@ class MailMover(Database):
             basename = str(uuid.uuid1()) + flagpart
         return os.path.join(destination, submaildir, basename)
 
+    def get_folder(self, fname):
+        """
+        Returns the maildir folder a mail file is in, relative to the
+        database path, like notmuch's ``folder:`` prefix sees it.
+        """
+        directory = os.path.dirname(fname)
+        if os.path.basename(directory) in ('cur', 'new'):
+            directory = os.path.dirname(directory)
+        folder = os.path.relpath(directory, self.db_path)
+        return '' if folder == '.' else folder
+
+    def plan(self, all_rules):
+        """
+        Decides which mail files to move where.
+
+        One query finds all messages any rule may apply to.  The rules are
+        matched against each of them in memory as far as they test tags; for
+        their other parts, one more query each finds the matching messages.
+        For each file, the first rule of its folder that matches wins.
+
+        :param all_rules: the rules of each folder, in order
+        :type  all_rules: dict of dicts mapping queries to destination folders
+        :returns: the planned moves
+        :rtype:   list of :class:`Move`
+        """
+        folder_queries = [
+            '(folder:"{folder}" AND ({rules}))'.format(
+                folder=maildir.replace("\"", "\\\""),
+                rules=' OR '.join('({})'.format(query) for query in rules))
+            for maildir, rules in all_rules.items() if rules]
+        if not folder_queries:
+            return []
+        main_query = '({}){}'.format(' OR '.join(folder_queries), self.age_query)
+
+        matching_ids = {}
+
+        def lookup(subquery):
+            if subquery not in matching_ids:
+                matching_ids[subquery] = set(
+                    message.messageid for message
+                    in self.db.get_messages('({}) AND ({})'.format(main_query, subquery)))
+            return matching_ids[subquery]
+
+        matchers = dict(
+            (maildir, [(query, destination, QueryMatcher(query, lookup))
+                       for query, destination in rules.items()])
+            for maildir, rules in all_rules.items())
+
+        logging.debug("query: {}".format(main_query))
+        moves = []
+        for message in self.db.get_messages(main_query):
+            # a single message (identified by Message-ID) can be in several
+            # places; only touch the one(s) in the folders with rules
+            fnames_by_folder = collections.OrderedDict()
+            for fname in (str(name) for name in message.filenames()):
+                folder = self.get_folder(fname)
+                if folder in matchers:
+                    fnames_by_folder.setdefault(folder, []).append(fname)
+
+            view = MessageView(message, {})
+            for maildir, fnames in fnames_by_folder.items():
+                for query, destination, matcher in matchers[maildir]:
+                    if matcher.matches(view):
+                        self.__log_move_action(message, maildir, destination,
+                                               self.dry_run)
+                        destination_path = '{}/{}/'.format(self.db_path, destination)
+                        for fname in fnames:
+                            moves.append(Move(message.messageid, fname,
+                                              self.get_new_name(fname, destination_path),
+                                              maildir, query))
+                        break
+        return moves
+
     def move(self, maildir, rules):
         """
         Move mails in folder maildir according to the given rules.
         """
-        # identify and move messages
-        logging.info("checking mails in '{}'".format(maildir))
-        to_delete_fnames = []
-        moved = False
-        for query in rules.keys():
-            destination = '{}/{}/'.format(self.db_path, rules[query])
-            main_query = self.query.format(
-                folder=maildir.replace("\"", "\\\""), subquery=query)
-            logging.debug("query: {}".format(main_query))
-            messages = self.db.get_messages(main_query)
-            for message in messages:
-                # a single message (identified by Message-ID) can be in several
-                # places; only touch the one(s) that exists in this maildir
-                all_message_fnames = (str(name) for name in message.filenames())
-                to_move_fnames = [name for name in all_message_fnames
-                                  if maildir in name]
-                if not to_move_fnames:
-                    continue
-                moved = True
-                self.__log_move_action(message, maildir, rules[query],
-                                       self.dry_run)
-                for fname in to_move_fnames:
-                    if self.dry_run:
-                        continue
-                    try:
-                        shutil.copy2(fname, self.get_new_name(fname, destination))
-                        to_delete_fnames.append(fname)
-                    except shutil.SameFileError:
-                        logging.warning("trying to move '{}' onto itself".format(fname))
-                        continue
-                    except shutil.Error as e:
-                        # this is ugly, but shutil does not provide more
-                        # finely individuated errors
-                        if str(e).endswith("already exists"):
-                            continue
-                        else:
-                            raise
-
-        # remove mail from source locations only after all copies are finished
-        for fname in set(to_delete_fnames):
-            os.remove(fname)
+        self.move_all({maildir: rules})
 
-        # update notmuch database
-        if not self.dry_run:
-            if moved:
-                logging.info("updating database")
-                self.__update_db(maildir)
-        else:
+    def move_all(self, all_rules):
+        """
+        Move mails in all given folders according to their rules.
+
+        :param all_rules: the rules of each folder, in order
+        :type  all_rules: dict of dicts mapping queries to destination folders
+        :returns: the planned moves
+        :rtype:   list of :class:`Move`
+        """
+        self.__finish_interrupted()
+        logging.info("checking mails in {}".format(', '.join("'{}'".format(maildir) for maildir in all_rules)))
+        planned = self.plan(all_rules)
+        self.__apply(planned)
+        return planned
+
+    def apply_plan(self, planned):
+        """
+        Carries out moves planned earlier, e.g. by a dry run, without
+        querying the database again.  Moves whose source file is gone are
+        skipped.
+
+        :param planned: the planned moves
+        :type  planned: list of :class:`Move`
+        """
+        self.__finish_interrupted()
+        for move in planned:
+            self.__log_move_action(None, move.folder, move.destination, self.dry_run)
+        self.__apply(planned)
+
+    def __finish_interrupted(self):
+        if self.dry_run:
+            return
+        recovered = self.recover()
+        if recovered:
+            logging.info("updating database")
+            self.__update_db(recovered)
+            self.journal.clear()
+
+    def __apply(self, planned):
+        if self.dry_run:
             logging.info("Would update database")
+            return
+
+        moves = collections.OrderedDict()
+        for move in planned:
+            if os.path.abspath(move.destination) == os.path.abspath(move.source):
+                logging.warning("trying to move '{}' onto itself".format(move.source))
+            elif not os.path.lexists(move.source):
+                logging.warning("not moving '{}', it does not exist anymore".format(move.source))
+            elif not os.path.lexists(move.destination):
+                moves.setdefault(move.source, []).append(move.destination)
 
-    def __update_db(self, maildir):
+        # record the moves, so that they can be finished after a crash
+        if moves:
+            self.journal.record(moves.items())
+        results = self.execute(moves.items())
+        failed = [result for result in results if result.error is not None]
+        if failed:
+            logging.error("Could not move {} of {} mails".format(len(failed), len(results)))
+
+        # update notmuch database
+        if planned:
+            logging.info("updating database")
+            self.__update_db([(result.source, result.destinations)
+                              for result in results if result.error is None])
+        self.journal.clear()
+
+    def execute(self, moves):
+        """
+        Moves files, possibly in parallel, and reports the outcome for each
+        of them; a file that can not be moved does not stop the others.
+
+        :param moves: ``(source, destinations)`` pairs
+        :type  moves: iterable
+        :returns: the outcome of each move, in order
+        :rtype:   list of :class:`MoveResult`
+        """
+        semaphores = collections.defaultdict(
+            lambda: threading.BoundedSemaphore(self.workers_per_destination))
+
+        def folder(destination):
+            # the maildir folder, moves into its cur and new count together
+            return os.path.dirname(os.path.dirname(destination))
+
+        def run(source, destinations):
+            folders = sorted(set(folder(destination) for destination in destinations))
+            locks = ([semaphores[name] for name in folders]
+                     if self.workers_per_destination else [])
+            try:
+                with contextlib.ExitStack() as stack:
+                    for lock in locks:
+                        stack.enter_context(lock)
+                    move_file(source, destinations)
+            except OSError as err:
+                logging.error("Could not move '{}': {}".format(source, err))
+                return MoveResult(source, destinations, err)
+            return MoveResult(source, destinations, None)
+
+        moves = list(moves)
+        if self.workers <= 1:
+            return [run(source, destinations) for source, destinations in moves]
+
+        # create the semaphores up front, the threads only look them up
+        for source, destinations in moves:
+            for destination in destinations:
+                semaphores[folder(destination)]
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            return list(executor.map(lambda move: run(*move), moves))
+
+    def recover(self):
+        """
+        Finishes the moves of a run that was interrupted, and returns them
+        as ``(source, destinations)`` pairs.  The database needs to be
+        updated afterwards, before the journal is cleared.
+        """
+        pending = self.journal.pending()
+        if not pending:
+            return pending
+
+        logging.warning('Finishing {} mail moves of an interrupted run'.format(len(pending)))
+        for fname, new_fnames in pending:
+            if not os.path.exists(fname):
+                continue
+            remaining = []
+            for new_fname in new_fnames:
+                try:
+                    if os.path.getsize(new_fname) == os.path.getsize(fname):
+                        continue
+                    # the copy was cut short
+                    os.remove(new_fname)
+                except FileNotFoundError:
+                    pass
+                remaining.append(new_fname)
+            if remaining:
+                move_file(fname, remaining)
+            else:
+                os.remove(fname)
+        return pending
+
+    def __update_db(self, moves):
         """
         Update the database after mail files have been moved in the filesystem.
         """
+        if not self.use_notmuch_new:
+            # the read-only handle used for the queries has to go first
+            self.db.close()
+            try:
+                self.db.move_messages(moves)
+                return
+            except notmuch2.NotmuchError as err:
+                logging.warning("Could not update notmuch database directly "
+                                "after moving mails, running notmuch new: {}".format(err))
+            finally:
+                self.db.close()
+
         try:
             if self.quiet:
                 check_call(['notmuch', 'new'] + self.notmuch_args.split(), stdout=DEVNULL, stderr=DEVNULL)
@@ -111,7 +415,7 @@ class MailMover(Database):
                 check_call(['notmuch', 'new'] + self.notmuch_args.split())
         except CalledProcessError as err:
             logging.error("Could not update notmuch database "
-                          "after syncing maildir '{}': {}".format(maildir, err))
+                          "after moving mails: {}".format(err))
             raise SystemExit
 
     def __log_move_action(self, message, source, destination, dry_run):
@@ -124,6 +428,10 @@ class MailMover(Database):
         else:
             level = logging.INFO
             prefix = 'I would move mail'
+        # summarizing a message reads its headers, skip it if nobody listens
+        if not logging.getLogger().isEnabledFor(level):
+            return
         logging.log(level, prefix)
-        logging.log(level, "    {}".format(get_message_summary(message).encode('utf8')))
+        if message is not None:
+            logging.log(level, "    {}".format(get_message_summary(message).encode('utf8')))
         logging.log(level, "from '{}' to '{}'".format(source, destination))
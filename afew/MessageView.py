@@ -0,0 +1,98 @@
+# SPDX-License-Identifier: ISC
+
+import notmuch2
+
+_UNSET = object()
+
+
+class MessageView:
+    """
+    Wraps a :class:`notmuch2.Message` while it is passed through a
+    :class:`afew.FilterChain.FilterChain`.
+
+    The message id, thread id, date, path, file names and headers are read
+    from the wrapped message once and then remembered, so filters looking at
+    the same values do not each go through the notmuch library again.  Other
+    attributes are delegated to the wrapped message.
+
+    The tags include the changes the chain has collected but not yet
+    written.
+
+    :param message: the wrapped message
+    :type  message: :class:`notmuch2.Message`
+    :param changes: pending changes, keyed by message id
+    :type  changes: dict of :class:`afew.FilterChain.TagChanges`
+    """
+
+    __slots__ = ('_message', '_changes', '_tags', '_headers', '_filenames',
+                 '_messageid', '_threadid', '_date', '_path')
+
+    def __init__(self, message, changes):
+        self._message = message
+        self._changes = changes
+        self._tags = None
+        self._headers = {}
+        self._filenames = None
+        self._messageid = _UNSET
+        self._threadid = _UNSET
+        self._date = _UNSET
+        self._path = _UNSET
+
+    def __getattr__(self, name):
+        return getattr(self._message, name)
+
+    @property
+    def messageid(self):
+        if self._messageid is _UNSET:
+            self._messageid = self._message.messageid
+        return self._messageid
+
+    @property
+    def threadid(self):
+        if self._threadid is _UNSET:
+            self._threadid = self._message.threadid
+        return self._threadid
+
+    @property
+    def date(self):
+        if self._date is _UNSET:
+            self._date = self._message.date
+        return self._date
+
+    @property
+    def path(self):
+        if self._path is _UNSET:
+            self._path = self._message.path
+        return self._path
+
+    def filenames(self):
+        if self._filenames is None:
+            self._filenames = tuple(self._message.filenames())
+        return iter(self._filenames)
+
+    def header(self, name):
+        '''
+        Returns the value of a header, like :meth:`notmuch2.Message.header`;
+        a missing header raises the same error every time it is asked for.
+        '''
+        key = name.lower()
+        value = self._headers.get(key, _UNSET)
+        if value is _UNSET:
+            try:
+                value = self._message.header(name)
+            except (LookupError, notmuch2.NotmuchError) as error:
+                value = error
+            self._headers[key] = value
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    @property
+    def tags(self):
+        if self._tags is None:
+            self._tags = frozenset(self._message.tags)
+        tags = self._tags
+        changes = self._changes.get(self.messageid)
+        if changes is not None:
+            tags = frozenset(changes.apply(tags))
+        return tags
@@ -0,0 +1,74 @@
+# SPDX-License-Identifier: ISC
+
+"""
+Journal of the mail file moves that are in progress.
+"""
+
+import json
+import logging
+import os
+import tempfile
+
+
+class MoveJournal:
+    """
+    Records the moves :class:`afew.MailMover.MailMover` is about to make, so
+    that the ones interrupted by a crash can be finished by the next run.
+
+    The journal is a file with one JSON ``[source, [destination, ...]]``
+    list per line.  It is written (and synced to disk) before any file is
+    moved, and removed once the moves are done and the index is updated.
+
+    :param path: the journal file
+    :type  path: str
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.log = logging.getLogger('{}.{}'.format(
+            self.__module__, self.__class__.__name__))
+
+    def record(self, moves):
+        """
+        Replaces the journal with the given moves.
+
+        :param moves: ``(source, destinations)`` pairs
+        :type  moves: iterable
+        """
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as journal_file:
+            for source, destinations in moves:
+                journal_file.write(json.dumps([source, list(destinations)]) + '\n')
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        os.replace(journal_file.name, self.path)
+
+    def pending(self):
+        """
+        Returns the recorded moves as ``(source, destinations)`` pairs.
+        """
+        try:
+            with open(self.path) as journal_file:
+                lines = journal_file.readlines()
+        except FileNotFoundError:
+            return []
+
+        moves = []
+        for line in lines:
+            try:
+                source, destinations = json.loads(line)
+            except ValueError:
+                self.log.warning('Ignoring malformed line in {!r}: {!r}'.format(self.path, line))
+                continue
+            moves.append((source, destinations))
+        return moves
+
+    def clear(self):
+        """
+        Removes the journal.
+        """
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
@@ -6,6 +6,10 @@ import os
 from afew.configparser import RawConfigParser
 
 notmuch_settings = RawConfigParser()
+# the same settings with the case of their names kept, for the search
+# prefixes of index.header.*
+notmuch_index_settings = RawConfigParser()
+notmuch_index_settings.optionxform = str
 
 
 def read_notmuch_settings(path=None):
@@ -14,6 +18,8 @@ def read_notmuch_settings(path=None):
 
     with open(path) as fp:
         notmuch_settings.read_file(fp)
+        fp.seek(0)
+        notmuch_index_settings.read_file(fp)
 
 
 def write_notmuch_settings(path=None):
@@ -31,3 +37,16 @@ def get_notmuch_new_tags():
 
 def get_notmuch_new_query():
     return '(%s)' % ' AND '.join('tag:%s' % tag for tag in get_notmuch_new_tags())
+
+
+def get_indexed_headers():
+    """
+    Returns the search prefixes of the headers notmuch indexes (configured
+    with `index.header.<prefix> = <header>`), keyed by lower case header name.
+    """
+    headers = {}
+    if notmuch_index_settings.has_section('index'):
+        for key, value in notmuch_index_settings.items('index'):
+            if key.startswith('header.') and value.strip():
+                headers[value.strip().lower()] = key[len('header.'):]
+    return headers
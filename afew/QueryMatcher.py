@@ -0,0 +1,238 @@
+# SPDX-License-Identifier: ISC
+
+"""
+Matching of notmuch queries against messages in memory.
+
+The tag terms of a query (``tag:`` and ``is:``) are checked against the tags a
+message carries right now, including changes that have not been written to the
+database yet.  Every other part of the query is handed to notmuch once, and the
+ids of the matching messages are remembered.
+"""
+
+import re
+
+_tag_term_re = re.compile(r'^(?:tag|is):(?P<tag>[^"*/(){}\s][^"*(){}\s]*|"(?:[^"]|"")*")$')
+
+# Operators we can evaluate ourselves. XOR, NEAR and ADJ make us fall back to
+# handing the whole query to notmuch.
+_operators = {'AND', 'OR', 'NOT'}
+_unsupported = {'XOR', 'NEAR', 'ADJ'}
+
+
+class UnsupportedQuery(Exception):
+    """
+    The query uses syntax the in-memory matcher does not understand.
+    """
+
+
+def tokenize(query):
+    """
+    Splits a notmuch query into terms, operators and parentheses.
+
+    Quoted strings and ``{...}`` subqueries are kept together as one term.
+    """
+    tokens = []
+    i, end = 0, len(query)
+    while i < end:
+        char = query[i]
+        if char.isspace():
+            i += 1
+        elif char in '()':
+            tokens.append(char)
+            i += 1
+        else:
+            start = i
+            depth = 0
+            while i < end:
+                char = query[i]
+                if char == '"':
+                    i += 1
+                    while i < end and query[i] != '"':
+                        i += 1
+                    if i == end:
+                        raise UnsupportedQuery('unbalanced quotes in %r' % query)
+                elif char == '{':
+                    depth += 1
+                elif char == '}':
+                    depth -= 1
+                elif depth == 0 and (char.isspace() or char in '()'):
+                    break
+                i += 1
+            if depth != 0:
+                raise UnsupportedQuery('unbalanced braces in %r' % query)
+            tokens.append(query[start:i])
+    return tokens
+
+
+class _Parser:
+    """
+    Recursive descent parser for the boolean structure of a notmuch query.
+
+    Nodes are tuples: ``('tag', name)``, ``('and', children)``,
+    ``('or', children)``, ``('not', child)``, ``('all',)`` for the empty
+    query, and ``('query', text)`` for every part without tag terms, which is
+    kept as written, so that it can be answered with one notmuch query.
+    """
+
+    def __init__(self, query):
+        self.tokens = tokenize(query)
+        self.pos = 0
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def text(self, start):
+        return ' '.join(self.tokens[start:self.pos])
+
+    def fold(self, start, node):
+        """
+        Returns `node`, or the text it was parsed from if it has no tag terms.
+        """
+        if _has_tags(node):
+            return node
+        return ('query', self.text(start))
+
+    def parse(self):
+        if not self.tokens:
+            return ('all',)
+        node = self.parse_or()
+        if self.peek() is not None:
+            raise UnsupportedQuery('unexpected %r' % self.peek())
+        return node
+
+    def parse_or(self):
+        start = self.pos
+        children = [self.parse_and()]
+        while self.peek() is not None and self.peek().upper() == 'OR':
+            self.next()
+            children.append(self.parse_and())
+        return self.fold(start, children[0] if len(children) == 1 else ('or', tuple(children)))
+
+    def parse_and(self):
+        start = self.pos
+        children = [self.parse_terms()]
+        while self.peek() is not None and self.peek().upper() in ('AND', 'NOT'):
+            if self.next().upper() == 'AND':
+                children.append(self.parse_terms())
+            else:
+                # "a NOT b" means "a AND NOT b"
+                children.append(('not', self.parse_terms()))
+        return self.fold(start, children[0] if len(children) == 1 else ('and', tuple(children)))
+
+    def parse_terms(self):
+        """
+        Parses terms next to each other without an operator.  notmuch
+        combines them depending on their prefixes (``tag:a tag:b`` means
+        ``tag:a OR tag:b``, but ``tag:a from:b`` means ``tag:a AND from:b``),
+        so they are only accepted if none of them test tags.
+        """
+        start = self.pos
+        children = [self.parse_unary()]
+        while self.peek() is not None and self.peek() != ')' and \
+                self.peek().upper() not in _operators:
+            children.append(self.parse_unary())
+        if len(children) == 1:
+            return children[0]
+        if any(_has_tags(child) for child in children):
+            raise UnsupportedQuery('tag terms without an operator in %r' % self.text(start))
+        return ('query', self.text(start))
+
+    def parse_unary(self):
+        start = self.pos
+        token = self.next()
+        if token is None:
+            raise UnsupportedQuery('unexpected end of query')
+        if token == '(':
+            node = self.parse_or()
+            if self.next() != ')':
+                raise UnsupportedQuery('unbalanced parentheses')
+            return node
+        if token == ')':
+            raise UnsupportedQuery('unbalanced parentheses')
+        upper = token.upper()
+        if upper == 'NOT':
+            return self.fold(start, ('not', self.parse_unary()))
+        if upper in _operators or upper in _unsupported or upper.startswith(('NEAR/', 'ADJ/')):
+            raise UnsupportedQuery('unsupported operator %r' % token)
+        if token[0] in '+-' or token.endswith(':'):
+            raise UnsupportedQuery('unsupported term %r' % token)
+        match = _tag_term_re.match(token)
+        if match:
+            tag = match.group('tag')
+            if tag.startswith('"'):
+                tag = tag[1:-1].replace('""', '"')
+            return ('tag', tag)
+        return ('query', token)
+
+
+def _has_tags(node):
+    kind = node[0]
+    if kind == 'tag':
+        return True
+    if kind == 'not':
+        return _has_tags(node[1])
+    if kind in ('and', 'or'):
+        return any(_has_tags(child) for child in node[1])
+    return False
+
+
+def parse(query):
+    """
+    Parses a notmuch query into a tree of nodes.
+
+    :raises: :class:`UnsupportedQuery` if the query can not be evaluated
+             in memory
+    """
+    return _Parser(query).parse()
+
+
+class QueryMatcher:
+    """
+    Decides whether a message matches a notmuch query, taking tag changes into
+    account that have not been written to the database yet.
+
+    :param query: the notmuch query
+    :type  query: str
+    :param lookup: called with a notmuch query string, returns the set of
+                   message ids matching it; used for all parts of the query
+                   that do not only test tags
+    :type  lookup: callable
+    """
+
+    def __init__(self, query, lookup):
+        self.query = query
+        self._lookup = lookup
+        try:
+            self._node = parse(query)
+        except UnsupportedQuery:
+            self._node = ('query', query)
+
+    def matches(self, message):
+        """
+        :param message: the message to check, its `tags` are expected to
+                        include pending changes
+        :type  message: :class:`afew.MessageView.MessageView`
+        :rtype: bool
+        """
+        return self._matches(self._node, message)
+
+    def _matches(self, node, message):
+        kind = node[0]
+        if kind == 'all':
+            return True
+        if kind == 'tag':
+            return node[1] in message.tags
+        if kind == 'query':
+            return message.messageid in self._lookup(node[1])
+        if kind == 'not':
+            return not self._matches(node[1], message)
+        if kind == 'and':
+            return all(self._matches(child, message) for child in node[1])
+        return any(self._matches(child, message) for child in node[1])
@@ -14,6 +14,11 @@ user_config_dir = os.path.join(os.environ.get('XDG_CONFIG_HOME',
                                'afew')
 user_config_dir = os.path.expandvars(user_config_dir)
 
+user_state_dir = os.path.join(os.environ.get('XDG_STATE_HOME',
+                                             os.path.expanduser('~/.local/state')),
+                              'afew')
+user_state_dir = os.path.expandvars(user_state_dir)
+
 settings = ConfigParser()
 # preserve the capitalization of the keys.
 settings.optionxform = str
@@ -24,6 +29,7 @@ settings.read(os.path.join(user_config_dir, 'config'))
 # All the values for keys listed here are interpreted as ;-delimited lists
 value_is_a_list = ['tags', 'tags_blacklist']
 mail_mover_section = 'MailMover'
+global_section = 'global'
 
 section_re = re.compile(r'^(?P<name>[a-z_][a-z0-9_]*)(\((?P<parent_class>[a-z_][a-z0-9_]*)\)|\.(?P<index>\d+))?$', re.I)
 
@@ -32,7 +38,7 @@ def get_filter_chain(database):
     filter_chain = []
 
     for section in settings.sections():
-        if section == 'global' or section == mail_mover_section:
+        if section == global_section or section == mail_mover_section:
             continue
 
         match = section_re.match(section)
@@ -100,3 +106,55 @@ def get_mail_move_rename():
     if settings.has_option(mail_mover_section, 'rename'):
         rename = settings.get(mail_mover_section, 'rename').lower() == 'true'
     return rename
+
+
+def get_mail_move_use_notmuch_new():
+    use_notmuch_new = False
+    if settings.has_option(mail_mover_section, 'use_notmuch_new'):
+        use_notmuch_new = settings.get(mail_mover_section, 'use_notmuch_new').lower() == 'true'
+    return use_notmuch_new
+
+
+def get_mail_move_workers():
+    workers = 1
+    if settings.has_option(mail_mover_section, 'workers'):
+        workers = settings.getint(mail_mover_section, 'workers')
+    return workers
+
+
+def get_mail_move_workers_per_destination():
+    workers = 0
+    if settings.has_option(mail_mover_section, 'workers_per_destination'):
+        workers = settings.getint(mail_mover_section, 'workers_per_destination')
+    return workers
+
+
+def get_commit_batch_size():
+    batch_size = 0
+    if settings.has_option(global_section, 'commit_batch_size'):
+        batch_size = settings.getint(global_section, 'commit_batch_size')
+        if batch_size < 0:
+            raise ValueError('commit_batch_size must be 0 (one transaction) or more, '
+                             'not {}'.format(batch_size))
+    return batch_size
+
+
+def get_watch_batch_window():
+    batch_window = 1.0
+    if settings.has_option(global_section, 'watch_batch_window'):
+        batch_window = settings.getfloat(global_section, 'watch_batch_window')
+    return batch_window
+
+
+def get_watch_batch_size():
+    batch_size = 500
+    if settings.has_option(global_section, 'watch_batch_size'):
+        batch_size = settings.getint(global_section, 'watch_batch_size')
+    return batch_size
+
+
+def get_watch_idle_release():
+    idle_release = 5.0
+    if settings.has_option(global_section, 'watch_idle_release'):
+        idle_release = settings.getfloat(global_section, 'watch_idle_release')
+    return idle_release
@@ -0,0 +1,128 @@
+# SPDX-License-Identifier: ISC
+
+import collections
+
+from afew.QueryMatcher import QueryMatcher
+
+_Member = collections.namedtuple('_Member', ('messageid', 'tags'))
+
+
+class ThreadIndex:
+    """
+    Remembers the tags of the messages in the threads a run looks at, so that
+    each thread is queried at most once.
+
+    Threads are loaded when they are first asked for, or in bulk with
+    :meth:`prefetch`.
+
+    :param database: the database to load threads from
+    :type  database: :class:`afew.Database.Database`
+    :param changes: tag changes that are not written yet, keyed by message
+                    id; they are taken into account when reporting tags
+    :type  changes: dict of :class:`afew.FilterChain.TagChanges`
+    """
+
+    def __init__(self, database, changes=None):
+        self.database = database
+        self.changes = {} if changes is None else changes
+        self._threads = {}
+        self._message_threads = {}
+        self._matching_ids = {}
+        self._tagged_threads = {}
+
+    def prefetch(self, query):
+        """
+        Loads all threads containing a message that matches the query.
+        """
+        threads = collections.defaultdict(dict)
+        for message in self.database.get_messages('thread:{%s}' % (query or '*')):
+            threads[message.threadid][message.messageid] = frozenset(message.tags)
+        for thread_id, members in threads.items():
+            if thread_id not in self._threads:
+                self._add_thread(thread_id, members)
+
+    def _add_thread(self, thread_id, members):
+        self._threads[thread_id] = members
+        for message_id in members:
+            self._message_threads[message_id] = thread_id
+
+    def _load(self, thread_id):
+        if thread_id not in self._threads:
+            self._add_thread(thread_id, dict(
+                (message.messageid, frozenset(message.tags))
+                for message in self.database.get_messages('thread:"%s"' % thread_id)))
+        return self._threads[thread_id]
+
+    def _thread_of(self, message_id):
+        if message_id not in self._message_threads:
+            self._message_threads[message_id] = None
+            for message in self.database.get_messages('id:"%s"' % message_id.replace('"', '""')):
+                self._message_threads[message_id] = message.threadid
+        return self._message_threads[message_id]
+
+    def members(self, thread_id):
+        """
+        Returns the messages of a thread as ``(messageid, tags)`` tuples,
+        with pending changes applied to the tags.
+        """
+        for message_id, tags in self._load(thread_id).items():
+            changes = self.changes.get(message_id)
+            if changes is not None:
+                tags = frozenset(changes.apply(tags))
+            yield _Member(message_id, tags)
+
+    def _lookup(self, thread_id, query):
+        key = (thread_id, query)
+        if key not in self._matching_ids:
+            self._matching_ids[key] = set(
+                message.messageid for message
+                in self.database.get_messages('(thread:"%s") AND (%s)' % (thread_id, query)))
+        return self._matching_ids[key]
+
+    def tags(self, thread_id, query=None):
+        """
+        Returns the union of the tags of all messages in a thread.
+
+        :param thread_id: the thread to look at
+        :type  thread_id: str
+        :param query: only consider the messages matching this notmuch query
+        :type  query: str
+        :rtype: frozenset
+        """
+        members = self.members(thread_id)
+        if query:
+            matcher = QueryMatcher(query, lambda subquery: self._lookup(thread_id, subquery))
+            members = filter(matcher.matches, members)
+
+        tags = set()
+        for member in members:
+            tags.update(member.tags)
+        return frozenset(tags)
+
+    def threads_with_tag(self, tag):
+        """
+        Returns the ids of all threads that contain a message with the given
+        tag.
+
+        The threads tagged in the database are found with a single query.
+        Threads with messages whose pending changes touch the tag are looked
+        at again, with the changes applied.
+
+        :rtype: set
+        """
+        if tag not in self._tagged_threads:
+            self._tagged_threads[tag] = frozenset(
+                message.threadid for message
+                in self.database.get_messages('tag:"%s"' % tag.replace('"', '""')))
+        threads = set(self._tagged_threads[tag])
+
+        changed_threads = set(self._thread_of(message_id)
+                              for message_id, changes in self.changes.items()
+                              if changes.flush or tag in changes.add or tag in changes.remove)
+        changed_threads.discard(None)
+        for thread_id in changed_threads:
+            if tag in self.tags(thread_id):
+                threads.add(thread_id)
+            else:
+                threads.discard(thread_id)
+        return threads
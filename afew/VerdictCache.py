@@ -0,0 +1,76 @@
+# SPDX-License-Identifier: ISC
+
+"""
+Persistent store for the results of verifying message files.
+"""
+
+import os
+import sqlite3
+import time
+
+
+class VerdictCache:
+    """
+    Remembers whether a message file passed a check, keyed by the message id
+    and the size and modification time of the file.  Renaming a file (e.g.
+    when its maildir flags change) keeps the key; changing it does not.
+
+    Changes are written to the SQLite database at `path` by :meth:`save`.
+
+    :param path: the SQLite database file
+    :type  path: str
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+
+    def _connect(self):
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._connection = sqlite3.connect(self.path)
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS verdicts ('
+                ' message_id TEXT NOT NULL,'
+                ' size INTEGER NOT NULL,'
+                ' mtime INTEGER NOT NULL,'
+                ' ok INTEGER NOT NULL,'
+                ' checked REAL NOT NULL,'
+                ' PRIMARY KEY (message_id, size, mtime))')
+        return self._connection
+
+    @staticmethod
+    def key(message_id, path):
+        """
+        Returns the key for a message file, or `None` if the file can not be
+        examined.
+        """
+        try:
+            stat_result = os.stat(path)
+        except OSError:
+            return None
+        return (message_id, stat_result.st_size, stat_result.st_mtime_ns)
+
+    def get(self, key):
+        """
+        Returns the stored verdict, or `None` if there is none.
+        """
+        row = self._connect().execute(
+            'SELECT ok FROM verdicts WHERE message_id = ? AND size = ? AND mtime = ?',
+            key).fetchone()
+        return None if row is None else bool(row[0])
+
+    def put(self, key, ok):
+        self._connect().execute(
+            'INSERT OR REPLACE INTO verdicts (message_id, size, mtime, ok, checked) '
+            'VALUES (?, ?, ?, ?, ?)',
+            key + (int(ok), time.time()))
+
+    def save(self):
+        """
+        Commits the stored verdicts and closes the database.
+        """
+        if self._connection is not None:
+            self._connection.commit()
+            self._connection.close()
+            self._connection = None
@@ -11,7 +11,11 @@ from afew.Database import Database
 from afew.main import main as inner_main
 from afew.FilterRegistry import all_filters
 from afew.Settings import user_config_dir, get_filter_chain, \
-    get_mail_move_rules, get_mail_move_age, get_mail_move_rename
+    get_mail_move_rules, get_mail_move_age, get_mail_move_rename, \
+    get_mail_move_use_notmuch_new, get_mail_move_workers, \
+    get_mail_move_workers_per_destination, \
+    get_commit_batch_size, get_watch_batch_window, get_watch_batch_size, \
+    get_watch_idle_release
 from afew.NotmuchSettings import read_notmuch_settings, get_notmuch_new_query
 from importlib.metadata import version
 
@@ -85,11 +89,28 @@ options_group.add_argument(
     help='be more verbose, can be given multiple times'
 )
 
+options_group.add_argument(
+    '-D', '--daemonize', default=False, action='store_true',
+    help='run in the background (in watch mode) [default: %(default)s]'
+)
+
 options_group.add_argument(
     '-N', '--notmuch-args', default='',
     help='arguments for notmuch new (in move mode)'
 )
 
+options_group.add_argument(
+    '--write-plan', metavar='FILE',
+    help="write the planned moves to FILE as JSON lines, '-' for stdout"
+         " (in move mode)"
+)
+
+options_group.add_argument(
+    '--apply-plan', metavar='FILE',
+    help="carry out the moves planned in FILE instead of checking the"
+         " folders, '-' for stdin (in move mode)"
+)
+
 
 def main():
     if sys.version_info < (3, 6):
@@ -107,6 +128,11 @@ def main():
     elif no_actions > 1:
         sys.exit('Please specify exactly one action')
 
+    if (args.write_plan or args.apply_plan) and not args.move_mails:
+        sys.exit('--write-plan and --apply-plan only work in move mode')
+    elif args.write_plan and args.apply_plan:
+        sys.exit('Please specify either --write-plan or --apply-plan')
+
     no_query_modifiers = len(list(filter(None, (args.all,
                                                 args.new, args.query))))
     if no_query_modifiers == 0 and not args.watch \
@@ -140,8 +166,21 @@ def main():
         args.mail_move_rules = get_mail_move_rules()
         args.mail_move_age = get_mail_move_age()
         args.mail_move_rename = get_mail_move_rename()
+        args.mail_move_use_notmuch_new = get_mail_move_use_notmuch_new()
+        args.mail_move_workers = get_mail_move_workers()
+        args.mail_move_workers_per_destination = get_mail_move_workers_per_destination()
+
+    if args.watch:
+        args.watch_batch_window = get_watch_batch_window()
+        args.watch_batch_size = get_watch_batch_size()
+        args.watch_idle_release = get_watch_idle_release()
+
+    try:
+        commit_batch_size = get_commit_batch_size()
+    except ValueError as e:
+        sys.exit('Invalid configuration: {}'.format(e))
 
-    with Database() as database:
+    with Database(commit_batch_size=commit_batch_size) as database:
         configured_filter_chain = get_filter_chain(database)
         if args.enable_filters:
             args.enable_filters = args.enable_filters.split(',')
@@ -1,197 +1,420 @@
 # SPDX-License-Identifier: ISC
 # Copyright (c) Justus Winter <4winter@informatik.uni-hamburg.de>
 
+import concurrent.futures
 import os
 import re
-import stat
 import logging
 import platform
 import queue
 import threading
+import time
 import notmuch2
 import pyinotify
-import ctypes
-import contextlib
+
+from afew.Database import AddedMessage
+from afew.FilterChain import FilterChain
 
 if platform.system() != 'Linux':
     raise ImportError('Unsupported platform: {!r}'.format(platform.system()))
 
+MASK = (
+    pyinotify.IN_CREATE |
+    pyinotify.IN_DELETE |
+    pyinotify.IN_MOVED_FROM |
+    pyinotify.IN_MOVED_TO)
+
+
+class WatchLimitError(Exception):
+    """
+    The inotify watch limit of the user has been reached.
+    """
+
+
+def add_watches(watch_manager, paths):
+    """
+    Watches the given directories.
+
+    :param watch_manager: the watch manager to add the watches to
+    :type  watch_manager: :class:`pyinotify.WatchManager`
+    :param paths: the directories to watch
+    :type  paths: iterable of str
+    :returns: the number of directories watched
+    :raises: :class:`WatchLimitError` if no more directories can be watched
+    """
+    count = 0
+    for path in paths:
+        try:
+            watch_manager.add_watch(path, MASK, quiet=False)
+        except pyinotify.WatchManagerError as e:
+            if 'ENOSPC' in str(e):
+                try:
+                    with open('/proc/sys/fs/inotify/max_user_watches') as limit_file:
+                        limit = limit_file.read().strip()
+                except OSError:
+                    limit = 'unknown'
+                raise WatchLimitError(
+                    'The inotify watch limit ({}) is exhausted, cannot watch {!r} and new mail in '
+                    'there would be missed. Raise the limit with '
+                    '`sysctl fs.inotify.max_user_watches=<number>`.'.format(limit, path)) from e
+            logging.warning('Could not watch {!r}: {}'.format(path, e))
+            continue
+        count += 1
+    return count
+
 
 class EventHandler(pyinotify.ProcessEvent):
-    def __init__(self, options, database):
+    """
+    Collects file events and processes them in batches.
+
+    A batch is processed once `batch_size` events have been collected, or
+    when `batch_window` seconds have passed since its first event.  All its
+    files are added to and removed from the database in one atomic section,
+    and the filter chain is run once over all new messages.
+
+    The database stays open between batches, and is closed once no events
+    have arrived for `idle_release` seconds, so that other programs (like
+    `notmuch new`) can get the write lock.
+
+    Directories that are created in (or moved into) a watched directory are
+    watched as well, and the mail already in them is added; directories
+    moved elsewhere are no longer watched.
+
+    A file renamed within the watched directories (e.g. when a mail client
+    changes its maildir flags) is the same message, so only its filename and
+    the tags from its maildir flags are updated; the filters do not run
+    again.  pyinotify pairs the ``IN_MOVED_FROM`` and ``IN_MOVED_TO`` events
+    of a rename by their cookie.  Repeated renames of a file in the same
+    batch are combined into one, and a new file renamed (or removed) before
+    its batch is processed is added under its last name (or not at all).
+    """
+    def __init__(self, options, database, batch_window=1.0, batch_size=500, idle_release=5.0,
+                 watch_manager=None):
         self.options = options
         self.database = database
+        self.watch_manager = watch_manager
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self.idle_release = idle_release
+        self._batch = []
+        self._batch_started = None
+        # position in the batch of the renames, by new pathname
+        self._renamed = {}
+        # position in the batch of the new files, by pathname
+        self._added = {}
+        self._idle_since = None
         super().__init__()
 
-    ignore_re = re.compile(r'(/xapian/.*(base.|tmp)$)|(\.lock$)|(/dovecot)')
+    ignore_re = re.compile(r'(/xapian/.*(base.|tmp)$)|(/\.notmuch/)|(\.lock$)|(/dovecot)')
+
+    def _queue(self, *event):
+        if not self._batch:
+            self._batch_started = time.monotonic()
+        if event[0] == 'rename':
+            self._renamed[event[1]] = len(self._batch)
+        elif event[0] == 'add':
+            self._added[event[1]] = len(self._batch)
+        self._batch.append(event)
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def _unqueue_rename(self, pathname):
+        """
+        Drops a queued rename to `pathname` from the batch, and returns the
+        pathname it was renamed from (or `pathname` if there is none).
+        """
+        index = self._renamed.pop(pathname, None)
+        if index is None:
+            return pathname
+        src_pathname = self._batch[index][2]
+        self._batch[index] = None
+        return src_pathname
+
+    def _unqueue_add(self, pathname, new_pathname=None):
+        """
+        Drops a queued add of `pathname` from the batch, or replaces it with
+        one of `new_pathname` if the file has been renamed.  Returns whether
+        there was one.
+        """
+        index = self._added.pop(pathname, None)
+        if index is None:
+            return False
+        if new_pathname is None:
+            self._batch[index] = None
+        else:
+            self._batch[index] = ('add', new_pathname)
+            self._added[new_pathname] = index
+        return True
+
+    def _watch_directory(self, path):
+        """
+        Watches a new directory and everything below it, and queues the
+        files already in there.
+        """
+        if is_blacklisted(path) or self.watch_manager is None:
+            return
+
+        logging.debug("Detected new directory: {!r}".format(path))
+        directories = list(find_directories(path))
+        try:
+            add_watches(self.watch_manager, directories)
+        except WatchLimitError as e:
+            logging.error(str(e))
+
+        # files that arrived before the directories were watched
+        for directory in directories:
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_file(follow_symlinks=False) and not self.ignore_re.search(entry.path):
+                            self._queue('add', entry.path)
+            except OSError as e:
+                logging.warning('Could not list directory {!r}: {}'.format(directory, e))
+
+    def _unwatch_directory(self, path):
+        """
+        Stops watching a directory and everything below it.
+        """
+        if self.watch_manager is None:
+            return
+        wd = self.watch_manager.get_wd(path)
+        if wd is not None:
+            logging.debug("Detected removed directory: {!r}".format(path))
+            self.watch_manager.rm_watch(wd, rec=True)
+
+    def process_IN_CREATE(self, event):
+        if event.dir:
+            self._watch_directory(event.pathname)
+
+    def process_IN_MOVED_FROM(self, event):
+        if event.dir:
+            self._unwatch_directory(event.pathname)
+
+    def process_IN_Q_OVERFLOW(self, event):
+        logging.error('The inotify event queue overflowed, new mail may have been missed. '
+                      'Run `notmuch new` to add it.')
 
     def process_IN_DELETE(self, event):
-        if self.ignore_re.search(event.pathname):
+        if event.dir or self.ignore_re.search(event.pathname):
             return
 
         logging.debug("Detected file removal: {!r}".format(event.pathname))
-        self.database.remove_message(event.pathname)
-        self.database.close()
+        if not self._unqueue_add(event.pathname):
+            self._queue('remove', self._unqueue_rename(event.pathname))
 
     def process_IN_MOVED_TO(self, event):
+        if event.dir:
+            self._watch_directory(event.pathname)
+            return
         if self.ignore_re.search(event.pathname):
             return
 
         src_pathname = event.src_pathname if hasattr(event, 'src_pathname') else None
         logging.debug("Detected file rename: {!r} -> {!r}".format(src_pathname, event.pathname))
+        if src_pathname is None:
+            self._queue('add', event.pathname)
+        elif not self._unqueue_add(src_pathname, event.pathname):
+            self._queue('rename', event.pathname, self._unqueue_rename(src_pathname))
+
+    def flush_if_due(self, notifier=None):
+        """
+        Processes the collected events if the batch window has passed, and
+        closes the database if it has been idle for long enough.
+
+        Meant to be used as the :meth:`pyinotify.Notifier.loop` callback.
+        """
+        now = time.monotonic()
+        if self._batch:
+            if now - self._batch_started >= self.batch_window:
+                self.flush()
+        elif self._idle_since is not None and now - self._idle_since >= self.idle_release:
+            logging.debug('Releasing the database after {:.1f} idle seconds'.format(now - self._idle_since))
+            self.close()
+
+    def close(self):
+        """
+        Closes the database.
+        """
+        self._idle_since = None
+        self.database.close()
 
-        def new_mail(message):
-            for filter_ in self.options.enable_filters:
+    def flush(self):
+        """
+        Processes the collected events.
+        """
+        batch, self._batch = [event for event in self._batch if event is not None], []
+        self._renamed = {}
+        self._added = {}
+        if not batch:
+            return
+
+        logging.debug('Processing {} file events'.format(len(batch)))
+        new_message_ids = []
+        try:
+            with self.database.open(rw=True).atomic():
+                # new files are added last, all at once
+                added = []
+                for event in batch:
+                    if event[0] == 'remove':
+                        self.database.remove_message(event[1])
+                    elif event[0] == 'rename':
+                        if not self._rename(event[1], event[2]):
+                            added.append(event[1])
+                    else:
+                        added.append(event[1])
+
+                for result in self.database.add_messages(added, sync_maildir_flags=True):
+                    if result.status == AddedMessage.NEW:
+                        new_message_ids.append(result.message.messageid)
+                    elif result.status == AddedMessage.ERROR:
+                        if isinstance(result.error, notmuch2.FileNotEmailError):
+                            logging.warning('File does not look like an email: {}'.format(result.error))
+                        else:
+                            logging.warning('Error opening mail file: {}'.format(result.error))
+
+            if new_message_ids:
+                chain = FilterChain(self.database, self.options.enable_filters)
                 try:
-                    filter_.run('id:"{}"'.format(message.messageid))
-                    filter_.commit(self.options.dry_run)
+                    chain.run(' OR '.join('id:"{}"'.format(message_id.replace('"', '""'))
+                                          for message_id in new_message_ids),
+                              dry_run=self.options.dry_run)
+                    chain.commit(self.options.dry_run)
                 except Exception as e:
-                    logging.warning('Error processing mail with filter {!r}: {}'.format(filter_.message, e))
-
+                    logging.warning('Error processing {} new mails: {}'.format(len(new_message_ids), e))
+        except BaseException:
+            self.close()
+            raise
+        self._idle_since = time.monotonic()
+
+    def _rename(self, pathname, src_pathname):
+        """
+        Updates the index after a rename, returns whether the file was known
+        under its old name.
+        """
         try:
-            self.database.add_message(event.pathname,
-                                      sync_flags=True,
-                                      new_mail_handler=new_mail)
-        except notmuch2.FileError as e:
-            logging.warning('Error opening mail file: {}'.format(e))
-            return
-        except notmuch2.FileNotEmailError as e:
-            logging.warning('File does not look like an email: {}'.format(e))
-            return
-        else:
-            if src_pathname:
-                self.database.remove_message(src_pathname)
-        finally:
-            self.database.close()
+            return self.database.rename_message(src_pathname, pathname) is not None
+        except (notmuch2.FileError, notmuch2.FileNotEmailError) as e:
+            logging.warning('Error renaming mail file: {}'.format(e))
+            return True
 
 
 def watch_for_new_files(options, database, paths, daemonize=False):
+    """
+    Adds new files in the given directories to the database and runs the
+    filters on them, until interrupted.
+
+    :param daemonize: detach from the terminal and run in the background;
+                      log messages are discarded then
+    :type  daemonize: bool
+    """
     wm = pyinotify.WatchManager()
-    mask = (
-        pyinotify.IN_DELETE |
-        pyinotify.IN_MOVED_FROM |
-        pyinotify.IN_MOVED_TO)
-    handler = EventHandler(options, database)
-    notifier = pyinotify.Notifier(wm, handler)
+    handler = EventHandler(options, database,
+                           batch_window=options.watch_batch_window,
+                           batch_size=options.watch_batch_size,
+                           idle_release=options.watch_idle_release,
+                           watch_manager=wm)
+    # wake up regularly to process pending events and release the database
+    timeout = min(options.watch_batch_window, options.watch_idle_release)
+    notifier = pyinotify.Notifier(wm, handler, timeout=max(1, int(timeout * 1000)))
 
     logging.debug('Registering inotify watch descriptors')
-    wdds = dict()
-    for path in paths:
-        wdds[path] = wm.add_watch(path, mask)
+    start_time = time.monotonic()
+    count = add_watches(wm, paths)
+    logging.info('Watching {} directories, found and registered in {:.2f} seconds'.format(
+        count, time.monotonic() - start_time))
 
-    # TODO: honor daemonize
     logging.debug('Running mainloop')
-    notifier.loop()
-
-
-try:
-    libc = ctypes.CDLL(ctypes.util.find_library("c"))
-except ImportError as e:
-    raise ImportError('Could not load libc: {}'.format(e))
-
-
-class Libc:
-    class c_dir(ctypes.Structure):
-        pass
-
-    c_dir_p = ctypes.POINTER(c_dir)
-
-    opendir = libc.opendir
-    opendir.argtypes = [ctypes.c_char_p]
-    opendir.restype = c_dir_p
-
-    closedir = libc.closedir
-    closedir.argtypes = [c_dir_p]
-    closedir.restype = ctypes.c_int
-
-    @classmethod
-    @contextlib.contextmanager
-    def open_directory(cls, path):
-        handle = cls.opendir(path)
-        yield handle
-        cls.closedir(handle)
-
-    class c_dirent(ctypes.Structure):
-        '''
-        man 3 readdir says::
-
-        On Linux, the dirent structure is defined as follows:
-
-           struct dirent {
-               ino_t          d_ino;       /* inode number */
-               off_t          d_off;       /* offset to the next dirent */
-               unsigned short d_reclen;    /* length of this record */
-               unsigned char  d_type;      /* type of file; not supported
-                                              by all file system types */
-               char           d_name[256]; /* filename */
-           };
-        '''
-        _fields_ = (
-            ('d_ino', ctypes.c_long),
-            ('d_off', ctypes.c_long),
-            ('d_reclen', ctypes.c_ushort),
-            ('d_type', ctypes.c_byte),
-            ('d_name', ctypes.c_char * 4096),
-        )
-
-    c_dirent_p = ctypes.POINTER(c_dirent)
-
-    readdir = libc.readdir
-    readdir.argtypes = [c_dir_p]
-    readdir.restype = c_dirent_p
-
-    # magic value for directory
-    DT_DIR = 4
-
-
-blacklist = {'.', '..', 'tmp'}
-
-
-def walk_linux(channel, path):
-    channel.put(path)
-
-    with Libc.open_directory(path) as handle:
-        while True:
-            dirent_p = Libc.readdir(handle)
-            if not dirent_p:
-                break
-
-            if dirent_p.contents.d_type == Libc.DT_DIR and \
-                    dirent_p.contents.d_name not in blacklist:
-                walk_linux(channel, os.path.join(path, dirent_p.contents.d_name))
-
-
-def walk(channel, path):
-    channel.put(path)
-
-    for child_path in (os.path.join(path, child)
-                       for child in os.listdir(path)
-                       if child not in blacklist):
+    try:
+        notifier.loop(callback=handler.flush_if_due, daemonize=daemonize, pid_file=False)
+    finally:
         try:
-            stat_result = os.stat(child_path)
-        except Exception:
-            continue
-
-        if stat_result.st_mode & stat.S_IFDIR:
-            walk(channel, child_path)
-
-
-def walker(channel, path):
-    walk_linux(channel, path)
-    channel.put(None)
-
-
-def quick_find_dirs_hack(path):
-    results = queue.Queue()
-
-    walker_thread = threading.Thread(target=walker, args=(results, path))
-    walker_thread.daemon = True
-    walker_thread.start()
-
-    while True:
-        result = results.get()
+            handler.flush()
+        finally:
+            handler.close()
+
+
+# the notmuch database (where `notmuch compact` creates xapian.compact and
+# xapian.old) and the maildir tmp folders
+blacklist = {'.notmuch', 'tmp', 'xapian'}
+
+
+def is_blacklisted(path):
+    """
+    Returns whether a directory is named like an entry in `blacklist`, or is
+    below the notmuch database directory.
+    """
+    return os.path.basename(path) in blacklist or '.notmuch' in path.split(os.sep)
+
+
+def find_directories(path, workers=8):
+    """
+    Yields `path` and all directories below it, as they are found.
+
+    Directories are listed with :func:`os.scandir` by a pool of threads.  A
+    thread walks its subtree on its own, and hands subdirectories over to
+    another thread whenever one is idle, so the order is not defined.
+    Symbolic links and directories named like an entry in `blacklist` are
+    skipped, with everything below them.
+
+    :param path: the directory to start from
+    :type  path: str
+    :param workers: number of threads listing directories
+    :type  workers: int
+    """
+    # directories found, or +1/-1 when a walking task is started/finished
+    results = queue.SimpleQueue()
+    stopped = threading.Event()
+    lock = threading.Lock()
+    waiting = [0]
+
+    def submit(directory):
+        with lock:
+            waiting[0] += 1
+        results.put(1)
+        executor.submit(scan, directory)
+
+    def scan(directory):
+        with lock:
+            waiting[0] -= 1
+        stack = [directory]
+        try:
+            while stack and not stopped.is_set():
+                current = stack.pop()
+                try:
+                    with os.scandir(current) as entries:
+                        subdirectories = [entry.path for entry in entries
+                                          if entry.name not in blacklist and
+                                          entry.is_dir(follow_symlinks=False)]
+                except OSError as e:
+                    logging.warning('Could not list directory {!r}: {}'.format(current, e))
+                    continue
+                results.put(subdirectories)
+                for subdirectory in subdirectories:
+                    # keep walking here, but hand the other subtrees over
+                    # while no task is waiting for a free thread
+                    if stack and not waiting[0]:
+                        submit(subdirectory)
+                    else:
+                        stack.append(subdirectory)
+        except RuntimeError:
+            # the executor was shut down because the caller stopped iterating
+            pass
+        finally:
+            results.put(-1)
 
-        if result is not None:
-            yield result
-        else:
-            break
+    executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix='afew-walk')
+    try:
+        yield path
+        submit(path)
+        unfinished = 0
+        while True:
+            result = results.get()
+            if isinstance(result, int):
+                unfinished += result
+                if not unfinished:
+                    break
+            else:
+                yield from result
+    finally:
+        stopped.set()
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -8,9 +8,10 @@ from afew.NotmuchSettings import get_notmuch_new_tags
 class ArchiveSentMailsFilter(SentMailsFilter):
     message = 'Archiving all mails sent by myself to others'
 
-    def __init__(self, database, sent_tag='', to_transforms=''):
-        super().__init__(database, sent_tag)
+    def __init__(self, database, sent_tag='', to_transforms='', address_batch_size=0):
+        super().__init__(database, sent_tag, address_batch_size=address_batch_size)
 
     def handle_message(self, message):
-        super().handle_message(message)
-        self.remove_tags(message, *get_notmuch_new_tags())
+        if self._is_sent_mail(message):
+            super().handle_message(message)
+            self.remove_tags(message, *get_notmuch_new_tags())
@@ -2,13 +2,32 @@
 # Copyright (c) Justus Winter <4winter@informatik.uni-hamburg.de>
 
 import collections
+import concurrent.futures
 import logging
 
+from afew.ThreadIndex import ThreadIndex
+
+# Stands in for a message after the query that returned it is done, when the
+# notmuch message object must not be used anymore.  Enough for add_tags and
+# remove_tags.
+MessageRef = collections.namedtuple('MessageRef', ('messageid',))
+
 
 class Filter:
     message = 'No message specified for filter'
     tags = []
     tags_blacklist = []
+    # set to True if handle_message looks at self.thread_index, so the
+    # filter gets a pass of its own in a FilterChain
+    uses_thread_index = False
+    # set to True as well if it looks at the threads of the messages it
+    # handles, so they are loaded in bulk before the messages are handled
+    prefetch_threads = False
+    # the pool :meth:`submit` runs work in, and how many messages may wait
+    # in :meth:`defer` per worker
+    workers = 1
+    executor_class = concurrent.futures.ThreadPoolExecutor
+    pending_per_worker = 4
 
     def __init__(self, database, **kwargs):
         super().__init__()
@@ -17,6 +36,7 @@ class Filter:
             self.__module__, self.__class__.__name__))
 
         self.database = database
+        self.thread_index = ThreadIndex(database)
         if 'tags' not in kwargs:
             kwargs['tags'] = self.tags
         for key, value in kwargs.items():
@@ -32,6 +52,8 @@ class Filter:
             (self._tags_to_add if tag_action[0] == '+' else self._tags_to_remove).append(tag_action[1:])
 
         self._tag_blacklist = set(self.tags_blacklist)
+        self._executor = None
+        self._pending = collections.deque()
 
     def flush_changes(self):
         '''
@@ -42,23 +64,78 @@ class Filter:
         self._remove_tags = collections.defaultdict(lambda: set())
         self._flush_tags = []
 
-    def run(self, query):
-        self.log.info(self.message)
-
+    def build_query(self, query):
+        '''
+        Restricts the given query to the messages this filter is
+        interested in.
+        '''
         if getattr(self, 'query', None):
             if query:
                 query = '(%s) AND (%s)' % (query, self.query)
             else:
                 query = self.query
+        return query
 
-        for message in self.database.get_messages(query):
+    def run(self, query):
+        self.log.info(self.message)
+
+        self.thread_index = ThreadIndex(self.database)
+        for message in self.database.get_messages(self.build_query(query)):
             self.handle_message(message)
+        self.finish()
 
     def handle_message(self, message):
         if not self._tag_blacklist.intersection(message.tags):
             self.remove_tags(message, *self._tags_to_remove)
             self.add_tags(message, *self._tags_to_add)
 
+    def finish(self):
+        '''
+        Called after the last message has been handled.  Hands the messages
+        still waiting in :meth:`defer` to :meth:`handle_result` and shuts the
+        worker pool down; filters that defer work in other ways enqueue their
+        remaining changes here.
+        '''
+        while self._pending:
+            self.handle_result(*self._pending.popleft())
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def submit(self, fn, *args):
+        '''
+        Runs ``fn(*args)`` in a pool of `workers` workers, started on first
+        use, and returns a :class:`concurrent.futures.Future` for the result.
+        '''
+        if self._executor is None:
+            self._executor = self.executor_class(self.workers)
+        return self._executor.submit(fn, *args)
+
+    def defer(self, message, result):
+        '''
+        Hands the message and `result` to :meth:`handle_result`; with more
+        than one worker, only once `pending_per_worker` messages per worker
+        are waiting after it (at the latest in :meth:`finish`), so that the
+        futures in `result` are computed while the following messages are
+        handled.
+
+        The message itself is only valid while its query runs, a
+        :class:`MessageRef` waits in its place.
+        '''
+        if self.workers > 1:
+            self._pending.append((MessageRef(message.messageid), result))
+            while len(self._pending) > self.workers * self.pending_per_worker:
+                self.handle_result(*self._pending.popleft())
+        else:
+            self.handle_result(message, result)
+
+    def handle_result(self, message, result):
+        '''
+        Called with each message passed to :meth:`defer` (or the
+        :class:`MessageRef` standing in for it) and its result.
+        '''
+        raise NotImplementedError
+
     def add_tags(self, message, *tags):
         if tags:
             self.log.debug('Adding tags %s to id:%s' % (', '.join(tags),
@@ -77,34 +154,28 @@ class Filter:
                        message.messageid)
         self._flush_tags.append(message.messageid)
 
+    def get_changes(self):
+        '''
+        Returns the enqueued changes as a dictionary mapping message ids
+        to ``(flush, tags_to_add, tags_to_remove)`` tuples.
+        '''
+        changes = {}
+        for message_id in set(self._flush_tags).union(self._add_tags, self._remove_tags):
+            changes[message_id] = (message_id in self._flush_tags,
+                                   self._add_tags.get(message_id, set()),
+                                   self._remove_tags.get(message_id, set()))
+        return changes
+
     def commit(self, dry_run=True):
-        dirty_messages = set()
-        dirty_messages.update(self._flush_tags)
-        dirty_messages.update(self._add_tags.keys())
-        dirty_messages.update(self._remove_tags.keys())
+        changes = self.get_changes()
 
-        if not dirty_messages:
+        if not changes:
             return
 
         if dry_run:
-            self.log.info('I would commit changes to %i messages' % len(dirty_messages))
+            self.log.info('I would commit changes to %i messages' % len(changes))
         else:
-            self.log.info('Committing changes to %i messages' % len(dirty_messages))
-            db = self.database.open(rw=True)
-
-            for message_id in dirty_messages:
-                message = db.find(message_id)
-
-                if message_id in self._flush_tags:
-                    message.remove_all_tags()
-
-                for tag in self._add_tags.get(message_id, []):
-                    message.tags.add(tag)
-
-                for tag in self._remove_tags.get(message_id, []):
-                    try:
-                        message.tags.remove(tag)
-                    except KeyError:
-                        pass
+            self.log.info('Committing changes to %i messages' % len(changes))
+            self.database.apply_tag_changes(changes)
 
         self.flush_changes()
@@ -7,45 +7,112 @@ DKIM validator filter.
 Verifies DKIM signature of an e-mail which has DKIM header.
 """
 
+import concurrent.futures
+import functools
 import logging
+import os
+import sqlite3
 
 import dkim
 import dns.exception
 
+from afew.DNSCache import DNSCache
 from afew.filters.BaseFilter import Filter
+from afew.Settings import user_state_dir
+from afew.VerdictCache import VerdictCache
 
 
 class DKIMVerifyError(Exception):
-    """Failed to verify DKIM signature.
+    """Failed to verify DKIM signature, e.g. because of a DNS problem; trying
+    again later may succeed.
     """
 
 
-def verify_dkim(path):
+def verify_dkim(path, dnsfunc=None):
     """
     Verify DKIM signature of an e-mail file.
 
     :param path: Path to the e-mail file.
+    :param dnsfunc: Function to look up DNS TXT records, dkimpy's default if
+                    `None`.
     :returns: Whether DKIM signature is valid or not.
+    :raises: :class:`DKIMVerifyError` if the public key could not be looked
+             up.
     """
     with open(path, 'rb') as message_file:
         message_bytes = message_file.read()
 
+    # unlike dkim.verify, DKIM.verify lets DNS errors through, so that they
+    # are not mistaken for invalid signatures
     try:
-        return dkim.verify(message_bytes)
-    except (dns.exception.DNSException, dkim.DKIMException) as exception:
+        verifier = dkim.DKIM(message_bytes)
+        if dnsfunc is None:
+            return verifier.verify()
+        return verifier.verify(dnsfunc=dnsfunc)
+    except (dns.exception.DNSException, dkim.DnsTimeoutError) as exception:
         raise DKIMVerifyError(str(exception)) from exception
+    except dkim.DKIMException:
+        return False
 
 
 class DKIMValidityFilter(Filter):
     """
     Verifies DKIM signature of an e-mail which has DKIM header.
+
+    With more than one worker, the signatures are verified in a thread pool,
+    see :meth:`afew.filters.BaseFilter.Filter.defer`.
+
+    The public keys looked up in DNS are cached for their TTL, across runs in
+    ``$XDG_STATE_HOME/afew/dkim-keys.json``.  With `dns_offline`, expired keys
+    are used when DNS lookups fail.
+
+    The verdict for every file is stored in
+    ``$XDG_STATE_HOME/afew/dkim-verdicts.sqlite`` and reused as long as the
+    file is unchanged, unless `verdict_refresh` is set.  Files that could not
+    be verified because of DNS problems are tagged as failed, but checked
+    again next time.
+
+    Config:
+
+    [DKIMValidityFilter]
+    ok_tag = dkim-ok
+    fail_tag = dkim-fail
+    workers = 8
+    dns_cache = true
+    dns_cache_size = 1000
+    dns_offline = false
+    verdict_cache = true
+    verdict_refresh = false
     """
     message = 'Verify DKIM signature'
     header = 'DKIM-Signature'
 
-    def __init__(self, database, ok_tag='dkim-ok', fail_tag='dkim-fail'):
+    def __init__(self,                     # pylint: disable=too-many-arguments
+                 database,
+                 ok_tag='dkim-ok',
+                 fail_tag='dkim-fail',
+                 workers=1,
+                 dns_cache='true',
+                 dns_cache_size=1000,
+                 dns_offline='false',
+                 verdict_cache='true',
+                 verdict_refresh='false'):
         super().__init__(database)
         self.dkim_tag = {True: ok_tag, False: fail_tag}
+        self.workers = int(workers)
+        if str(dns_cache).lower() == 'true':
+            self.dns_cache = DNSCache(os.path.join(user_state_dir, 'dkim-keys.json'),
+                                      max_entries=int(dns_cache_size),
+                                      offline=str(dns_offline).lower() == 'true')
+            self._dnsfunc = self.dns_cache.get_txt
+        else:
+            self.dns_cache = None
+            self._dnsfunc = None
+        if str(verdict_cache).lower() == 'true':
+            self.verdicts = VerdictCache(os.path.join(user_state_dir, 'dkim-verdicts.sqlite'))
+        else:
+            self.verdicts = None
+        self.verdict_refresh = str(verdict_refresh).lower() == 'true'
         self.log = logging.getLogger('{}.{}'.format(
             self.__module__, self.__class__.__name__))
 
@@ -55,14 +122,61 @@ class DKIMValidityFilter(Filter):
         except LookupError:
             selfhead = ''
         if selfhead:
-            try:
-                dkim_ok = all(map(verify_dkim, message.filenames()))
-            except DKIMVerifyError as verify_error:
-                self.log.warning(
-                    "Failed to verify DKIM of '%s': %s "
-                    "(marked as 'dkim-fail')",
-                    message.messageid,
-                    verify_error
-                )
-                dkim_ok = False
-            self.add_tags(message, self.dkim_tag[dkim_ok])
+            self.defer(message, [self._verify(message, filename)
+                                 for filename in message.filenames()])
+
+    def _verify(self, message, filename):
+        """
+        Returns the verdict cache key of a file and its verdict: a boolean
+        if it is cached, otherwise a future (with workers) or a function
+        computing it.
+        """
+        key = None
+        if self.verdicts is not None:
+            key = self.verdicts.key(message.messageid, filename)
+            if key is not None and not self.verdict_refresh:
+                verdict = self.verdicts.get(key)
+                if verdict is not None:
+                    return key, verdict
+
+        if self.workers > 1:
+            return key, self.submit(verify_dkim, filename, self._dnsfunc)
+        return key, functools.partial(verify_dkim, filename, self._dnsfunc)
+
+    def _result(self, key, result):
+        if isinstance(result, bool):
+            return result
+        if isinstance(result, concurrent.futures.Future):
+            result = result.result()
+        else:
+            result = result()
+        if key is not None:
+            self.verdicts.put(key, result)
+        return result
+
+    def finish(self):
+        super().finish()
+        try:
+            if self.dns_cache is not None:
+                self.dns_cache.save()
+            if self.verdicts is not None:
+                self.verdicts.save()
+        except (OSError, sqlite3.Error) as error:
+            self.log.warning('Could not save the DKIM caches: %s', error)
+
+    def handle_result(self, message, results):
+        """
+        Tags a message according to the results of verifying its files, as
+        returned by :meth:`_verify`.
+        """
+        try:
+            dkim_ok = all(self._result(key, result) for key, result in results)
+        except DKIMVerifyError as verify_error:
+            self.log.warning(
+                "Failed to verify DKIM of '%s': %s "
+                "(marked as 'dkim-fail')",
+                message.messageid,
+                verify_error
+            )
+            dkim_ok = False
+        self.add_tags(message, self.dkim_tag[dkim_ok])
@@ -13,11 +13,15 @@ Add tags 2 of the tags below:
 
 """
 
+import concurrent.futures
+import email
+import gzip
+import io
 import logging
 import re
-import tempfile
 import xml.etree.ElementTree as ET
 import zipfile
+import zlib
 
 from .BaseFilter import Filter
 
@@ -27,32 +31,47 @@ class DMARCInspectionError(Exception):
     """
 
 
+ZIP_CONTENT_TYPES = ('application/zip', 'application/x-zip-compressed')
+GZIP_CONTENT_TYPES = ('application/gzip', 'application/x-gzip')
+XML_CONTENT_TYPES = ('application/xml', 'text/xml')
+
+
 class ReportFilesIterator:
     """
-    Iterator over DMARC reports files attached to the e-mail either directly or
-    in ZIP files.
+    Iterator over DMARC reports files attached to the e-mail either directly,
+    in ZIP files or gzip compressed.
 
-    Returns content of each document file (as bytes, not as string) which needs
-    to be decoded from charset encoding.
+    Returns a binary file object for each document.  Compressed documents are
+    decompressed while they are read, from a buffer holding the decoded
+    attachment.
+
+    :param path: Path to the e-mail file.
     """
-    def __init__(self, message):
-        self.message = message
+    def __init__(self, path):
+        self.path = path
 
     def __iter__(self):
-        for part in self.message.get_message_parts():
-            if part.get_content_type() == 'application/zip':
-                with tempfile.TemporaryFile(suffix='.zip') as file:
-                    file.write(part.get_payload(decode=True))
-                    try:
-                        with zipfile.ZipFile(file) as zip_file:
-                            for member_file in zip_file.infolist():
-                                if member_file.filename.endswith('.xml'):
-                                    yield zip_file.read(member_file)
-                    except zipfile.BadZipFile as zip_error:
-                        raise DMARCInspectionError(str(zip_error)) \
-                            from zip_error
-            elif part.get_content_type() == 'application/xml':
-                yield part.get_payload(decode=True)
+        with open(self.path, 'rb') as message_file:
+            mail = email.message_from_binary_file(message_file)
+
+        for part in mail.walk():
+            content_type = part.get_content_type()
+            filename = part.get_filename() or ''
+            if content_type in ZIP_CONTENT_TYPES or filename.endswith('.zip'):
+                try:
+                    with zipfile.ZipFile(io.BytesIO(part.get_payload(decode=True))) as zip_file:
+                        for member_file in zip_file.infolist():
+                            if member_file.filename.endswith('.xml'):
+                                with zip_file.open(member_file) as document:
+                                    yield document
+                except zipfile.BadZipFile as zip_error:
+                    raise DMARCInspectionError(str(zip_error)) \
+                        from zip_error
+            elif content_type in GZIP_CONTENT_TYPES or filename.endswith('.xml.gz'):
+                with gzip.GzipFile(fileobj=io.BytesIO(part.get_payload(decode=True))) as document:
+                    yield document
+            elif content_type in XML_CONTENT_TYPES:
+                yield io.BytesIO(part.get_payload(decode=True))
 
 
 def and_dict(dict1, dict2):
@@ -81,7 +100,7 @@ def has_failed(node):
     :param node: XML node holding status as text.
     :returns: Whether the status is reported as "failed".
     """
-    if not node or not node.text:
+    if node is None or not node.text:
         return True
     return (node.text.strip() not in ['pass', 'none'])
 
@@ -94,33 +113,73 @@ def read_auth_results(document):
     `True` only and only if all of the records of particular type (DKIM or SPF)
     are "pass".
 
+    The document is parsed incrementally, each record is discarded once it has
+    been looked at.
+
+    :param document: The document as binary file object or bytes.
     :returns: Results as a dictionary where keys are: `dkim` and `spf` and
     values are boolean values.
     """
+    if isinstance(document, bytes):
+        document = io.BytesIO(document)
+
+    results = {'dkim': True, 'spf': True}
+    depth = 0
+    root = None
     try:
-        results = {'dkim': True, 'spf': True}
-        root = ET.fromstring(document)
-        for record in root.findall('record'):
-            auth_results = record.find('auth_results')
-            if auth_results:
+        for event, element in ET.iterparse(document, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = element
+                depth += 1
+                continue
+
+            depth -= 1
+            if depth != 1 or element.tag != 'record':
+                continue
+
+            auth_results = element.find('auth_results')
+            if auth_results is not None:
                 dkim = auth_results.find('dkim')
-                if dkim:
-                    dkim = dkim.find('result')
-                    results['dkim'] &= not has_failed(dkim)
+                if dkim is not None:
+                    results['dkim'] &= not has_failed(dkim.find('result'))
                 spf = auth_results.find('spf')
-                if spf:
-                    spf = spf.find('result')
-                    results['spf'] &= not has_failed(spf)
+                if spf is not None:
+                    results['spf'] &= not has_failed(spf.find('result'))
+            root.clear()
     except ET.ParseError as parse_error:
         raise DMARCInspectionError(str(parse_error)) from parse_error
+    except (OSError, EOFError, zlib.error, zipfile.BadZipFile) as read_error:
+        # raised while decompressing the document
+        raise DMARCInspectionError(str(read_error)) from read_error
 
     return results
 
 
+def inspect_report(path):
+    """
+    Inspect all DMARC reports attached to an e-mail.
+
+    Only takes and returns picklable values, so that it can be run in a
+    worker process.
+
+    :param path: Path to the e-mail file.
+    :returns: Results as a dictionary where keys are: `dkim` and `spf` and
+    values are boolean values.
+    """
+    auth_results = {'dkim': True, 'spf': True}
+    for document in ReportFilesIterator(path):
+        auth_results = and_dict(auth_results, read_auth_results(document))
+    return auth_results
+
+
 class DMARCReportInspectionFilter(Filter):
     """
     Inspect DMARC reports for DKIM and SPF status.
 
+    With more than one worker, the reports are inspected in a process pool,
+    see :meth:`afew.filters.BaseFilter.Filter.defer`.
+
     Config:
 
     [DMARCReportInspectionFilter]
@@ -129,20 +188,25 @@ class DMARCReportInspectionFilter(Filter):
     spf_ok_tag = "dmarc/spf-ok"
     spf_fail_tag = "dmarc/spf-fail"
     subject_regexp = "^report domain:"
+    workers = 4
 
     """
+    executor_class = concurrent.futures.ProcessPoolExecutor
+
     def __init__(self,                     # pylint: disable=too-many-arguments
                  database,
                  dkim_ok_tag='dmarc/dkim-ok',
                  dkim_fail_tag='dmarc/dkim-fail',
                  spf_ok_tag='dmarc/spf-ok',
                  spf_fail_tag='dmarc/spf-fail',
-                 subject_regexp=r'^report domain:'):
+                 subject_regexp=r'^report domain:',
+                 workers=1):
         super().__init__(database)
         self.dkim_tag = {True: dkim_ok_tag, False: dkim_fail_tag}
         self.spf_tag = {True: spf_ok_tag, False: spf_fail_tag}
         self.dmarc_subject = re.compile(subject_regexp,
                                         flags=re.IGNORECASE)
+        self.workers = int(workers)
         self.log = logging.getLogger('{}.{}'.format(
             self.__module__, self.__class__.__name__))
 
@@ -150,13 +214,21 @@ class DMARCReportInspectionFilter(Filter):
         if not self.dmarc_subject.match(message.header('Subject')):
             return
 
-        auth_results = {'dkim': True, 'spf': True}
+        if self.workers > 1:
+            self.defer(message, self.submit(inspect_report, message.path))
+        else:
+            self.defer(message, None)
 
+    def handle_result(self, message, future):
+        """
+        Tags a message according to its reports, inspecting them unless the
+        result is computed by `future`.
+        """
         try:
-            for file_content in ReportFilesIterator(message):
-                document = file_content.decode('UTF-8')
-                auth_results = and_dict(auth_results,
-                                        read_auth_results(document))
+            if future is None:
+                auth_results = inspect_report(message.path)
+            else:
+                auth_results = future.result()
 
             self.add_tags(message,
                           'dmarc',
@@ -2,9 +2,15 @@
 # Copyright (c) dtk <dtk@gmx.de>
 
 from afew.filters.BaseFilter import Filter
+import functools
+import logging
+import os
 import re
 import shlex
 
+# number of maildir directories whose tags are remembered
+DIRECTORY_CACHE_SIZE = 4096
+
 
 class FolderNameFilter(Filter):
     message = 'Tags all new messages with their folder'
@@ -13,43 +19,50 @@ class FolderNameFilter(Filter):
                  maildir_separator='.', folder_explicit_list='', folder_lowercases=''):
         super().__init__(database)
 
-        self.__filename_pattern = '{mail_root}/(?P<maildirs>.*)/(cur|new)/[^/]+'.format(
-            mail_root=database.db_path.rstrip('/'))
+        self.__directory_pattern = re.compile('{mail_root}/(?P<maildirs>.*)/(cur|new)'.format(
+            mail_root=re.escape(database.db_path.rstrip('/'))))
         self.__folder_explicit_list = set(shlex.split(folder_explicit_list))
         self.__folder_blacklist = set(shlex.split(folder_blacklist))
         self.__folder_transforms = self.__parse_transforms(folder_transforms)
         self.__folder_lowercases = folder_lowercases != ''
         self.__maildir_separator = maildir_separator
+        # many messages share a directory, compute its tags only once
+        self.__directory_tags = functools.lru_cache(maxsize=DIRECTORY_CACHE_SIZE)(
+            self.__get_directory_tags)
 
     def handle_message(self, message):
-        # Find all the dirs in the mail directory that this message
-        # belongs to
-        maildirs = [re.match(self.__filename_pattern, str(filename))
-                    for filename in message.filenames()]
-        maildirs = filter(None, maildirs)
-        if maildirs:
-            # Make the folders relative to mail_root and split them.
-            folder_groups = [maildir.group('maildirs').split(self.__maildir_separator)
-                             for maildir in maildirs]
-            folders = set([folder
-                           for folder_group in folder_groups
-                           for folder in folder_group])
-            try:
-                subject = message.header('subject')
-            except LookupError:
-                subject = ''
-            self.log.debug('found folders {} for message {!r}'.format(
-                folders, subject))
+        # Find the tags of all the dirs in the mail directory that this
+        # message belongs to
+        tags = set()
+        for filename in message.filenames():
+            tags.update(self.__directory_tags(os.path.dirname(str(filename))))
+        if tags:
+            if self.log.isEnabledFor(logging.DEBUG):
+                try:
+                    subject = message.header('subject')
+                except LookupError:
+                    subject = ''
+                self.log.debug('found folder tags {} for message {!r}'.format(
+                    tags, subject))
+            self.add_tags(message, *tags)
 
-            # remove blacklisted folders
-            clean_folders = folders - self.__folder_blacklist
-            if self.__folder_explicit_list:
-                # only explicitly listed folders
-                clean_folders &= self.__folder_explicit_list
-            # apply transformations
-            transformed_folders = self.__transform_folders(clean_folders)
+    def __get_directory_tags(self, directory):
+        """
+        Returns the tags for the messages in a maildir directory.
+        """
+        maildir = self.__directory_pattern.fullmatch(directory)
+        if maildir is None:
+            return frozenset()
+        # Make the folders relative to mail_root and split them.
+        folders = set(maildir.group('maildirs').split(self.__maildir_separator))
 
-            self.add_tags(message, *transformed_folders)
+        # remove blacklisted folders
+        clean_folders = folders - self.__folder_blacklist
+        if self.__folder_explicit_list:
+            # only explicitly listed folders
+            clean_folders &= self.__folder_explicit_list
+        # apply transformations
+        return frozenset(self.__transform_folders(clean_folders))
 
     def __transform_folders(self, folders):
         """
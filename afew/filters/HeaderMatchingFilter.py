@@ -5,11 +5,46 @@
 # Copyright (c) 2014 Lars Kellogg-Stedman <lars@redhat.com>
 
 from afew.filters.BaseFilter import Filter
+from afew.NotmuchSettings import get_indexed_headers
 
 from notmuch2._errors import NullPointerError
 
+import collections
 import re
 
+# patterns using back references can not be merged, their group numbers
+# would change
+_BACKREFERENCE = re.compile(r'\\[1-9]|\(\?P=')
+_NAMED_GROUP = re.compile(r'\(\?P<\w+>')
+# whole words, which notmuch can look up: the text between the anchors must
+# be words (of at most 64 characters, longer ones are not indexed) and spaces
+_WHOLE_WORDS = re.compile(r'(?:\^|\\b)([A-Za-z0-9]{1,64}(?: [A-Za-z0-9]{1,64})*)(?:\$|\\b)')
+
+
+def header_query(header, pattern):
+    '''
+    Returns a notmuch query finding (at least) the messages whose header
+    matches a pattern, or `None` if there is none: the header has to be
+    indexed by notmuch (see `index.header.*` in notmuch-config(1)), and the
+    pattern has to be ASCII words separated by single spaces, starting with
+    ``^`` or ``\\b`` and ending with ``$`` or ``\\b``.  notmuch looks up
+    whole words, so it would miss text a pattern finds within a word.
+    '''
+    prefix = get_indexed_headers().get(header.lower())
+    if prefix is None or not isinstance(pattern, str):
+        return None
+    match = _WHOLE_WORDS.fullmatch(pattern)
+    if match is None:
+        return None
+    return '%s:"%s"' % (prefix, match.group(1))
+
+
+def _get_header(message, header):
+    try:
+        return message.header(header)
+    except (NullPointerError, LookupError):
+        return None
+
 
 class HeaderMatchingFilter(Filter):
     message = 'Tagging based on specific header values matching a given RE'
@@ -19,18 +54,104 @@ class HeaderMatchingFilter(Filter):
     def __init__(self, database, **kwargs):
         super().__init__(database, **kwargs)
         if self.pattern is not None:
+            if self.header is not None:
+                # let notmuch find the candidates if it can
+                pushed_down = header_query(self.header, self.pattern)
+                if pushed_down:
+                    query = getattr(self, 'query', None)
+                    self.query = '(%s) AND (%s)' % (query, pushed_down) if query else pushed_down
             self.pattern = re.compile(self.pattern, re.I)
 
     def handle_message(self, message):
         if self.header is not None and self.pattern is not None:
             if not self._tag_blacklist.intersection(message.tags):
-                try:
-                    value = message.header(self.header)
-                    match = self.pattern.search(value)
-                    if match:
-                        tagdict = {k: v.lower() for k, v in match.groupdict().items()}
-                        sub = (lambda tag: tag.format(**tagdict))
-                        self.remove_tags(message, *map(sub, self._tags_to_remove))
-                        self.add_tags(message, *map(sub, self._tags_to_add))
-                except (NullPointerError, LookupError):
-                    pass
+                value = _get_header(message, self.header)
+                if value is not None:
+                    self.handle_header_value(message, value)
+
+    def handle_header_value(self, message, value):
+        '''
+        Tags the message if the value of its header matches the pattern.
+        '''
+        if self._tag_blacklist.intersection(message.tags):
+            return
+        match = self.pattern.search(value)
+        if match:
+            tagdict = {k: v.lower() for k, v in match.groupdict().items()}
+            sub = (lambda tag: tag.format(**tagdict))
+            self.remove_tags(message, *map(sub, self._tags_to_remove))
+            self.add_tags(message, *map(sub, self._tags_to_add))
+
+
+class HeaderMatchingGroup:
+    """
+    Evaluates the header filters of a :class:`afew.FilterChain.FilterChain`
+    pass together, so that a message's headers are read once each, no matter
+    how many filters look at them.
+
+    For headers several filters look at, all their patterns are combined
+    into one, which is searched first; if it does not match, none of the
+    filters are asked.  Otherwise the filters are still run one by one, in
+    chain order, with their own blacklists and tag templates.
+
+    Only filters that do not override
+    :meth:`HeaderMatchingFilter.handle_message` take part.
+
+    :param filters: the filters of the pass
+    :type  filters: list of :class:`afew.filters.BaseFilter.Filter`
+    """
+
+    def __init__(self, filters):
+        self.filters = set()
+        patterns = collections.defaultdict(list)
+        for filter_ in filters:
+            if (isinstance(filter_, HeaderMatchingFilter) and
+                    type(filter_).handle_message is HeaderMatchingFilter.handle_message and
+                    filter_.header is not None and filter_.pattern is not None):
+                self.filters.add(filter_)
+                patterns[filter_.header.lower()].append(filter_.pattern.pattern)
+
+        self._screens = {}
+        for header, header_patterns in patterns.items():
+            if len(header_patterns) > 1:
+                self._screens[header] = self._combine(header_patterns)
+        self.start(None)
+
+    @staticmethod
+    def _combine(patterns):
+        '''
+        Returns a pattern matching whatever any of the given ones match, or
+        `None` if they can not be combined.
+        '''
+        if any(_BACKREFERENCE.search(pattern) for pattern in patterns):
+            return None
+        try:
+            return re.compile('|'.join('(?:%s)' % _NAMED_GROUP.sub('(?:', pattern)
+                                       for pattern in patterns), re.I)
+        except re.error:
+            return None
+
+    def __contains__(self, filter_):
+        return filter_ in self.filters
+
+    def start(self, message):
+        '''
+        Forgets the header values of the previous message.
+        '''
+        self._message = message
+        self._values = {}
+
+    def handle_message(self, filter_, message):
+        '''
+        Runs a filter of the group on the current message.
+        '''
+        header = filter_.header.lower()
+        if header not in self._values:
+            value = _get_header(self._message, filter_.header)
+            screen = self._screens.get(header)
+            if value is not None and screen is not None and not screen.search(value):
+                value = None
+            self._values[header] = value
+        value = self._values[header]
+        if value is not None:
+            filter_.handle_header_value(message, value)
@@ -7,9 +7,19 @@ from afew.filters.BaseFilter import Filter
 class KillThreadsFilter(Filter):
     message = 'Looking for messages in killed threads that are not yet killed'
     query = 'NOT tag:killed'
+    # runs after the filters before it are done, so threads they killed
+    # count; only looks up the killed threads, so nothing is prefetched
+    uses_thread_index = True
 
-    def handle_message(self, message):
-        query = self.database.get_messages('thread:"%s" AND tag:killed' % message.threadid)
+    def __init__(self, database, **kwargs):
+        super().__init__(database, **kwargs)
+        self._killed_threads = None
 
-        if len(list(query)):
+    def handle_message(self, message):
+        if self._killed_threads is None:
+            self._killed_threads = self.thread_index.threads_with_tag('killed')
+        if message.threadid in self._killed_threads:
             self.add_tags(message, 'killed')
+
+    def finish(self):
+        self._killed_threads = None
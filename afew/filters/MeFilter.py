@@ -1,30 +1,38 @@
 # SPDX-License-Identifier: ISC
 # Copyright (c) Amadeusz Zolnowski <aidecoe@aidecoe.name>
 
-import re
-
+from afew.AddressIndex import AddressIndex
 from afew.filters.BaseFilter import Filter
-from afew.NotmuchSettings import notmuch_settings
 
 
 class MeFilter(Filter):
     message = 'Tagging all mails sent directly to myself'
-    _bare_email_re = re.compile(r"[^<]*<(?P<email>[^@<>]+@[^@<>]+)>")
 
-    def __init__(self, database, me_tag='to-me', tags_blacklist=[]):
+    def __init__(self, database, me_tag='to-me', tags_blacklist=[], address_batch_size=0):
         super().__init__(database, tags_blacklist=tags_blacklist)
 
-        my_addresses = set()
-        my_addresses.add(notmuch_settings.get('user', 'primary_email'))
-        if notmuch_settings.has_option('user', 'other_email'):
-            for other_email in notmuch_settings.get_list('user', 'other_email'):
-                my_addresses.add(other_email)
-
-        self.query = ' OR '.join('to:"%s"' % address
-                                 for address in my_addresses)
+        self.my_addresses = AddressIndex.mine()
+        self.address_batch_size = int(address_batch_size)
+        if not self.address_batch_size:
+            self.query = self.my_addresses.query('to')
+        self.__run_query = ''
+        self.__to_me_ids = None
 
         self.me_tag = me_tag
 
+    def build_query(self, query):
+        # with batched address queries, the messages sent to me are looked
+        # up when the first message of this run is handled
+        self.__run_query = query
+        self.__to_me_ids = None
+        return super().build_query(query)
+
     def handle_message(self, message):
+        if self.address_batch_size:
+            if self.__to_me_ids is None:
+                self.__to_me_ids = self.my_addresses.message_ids(
+                    self.database, 'to', self.__run_query, self.address_batch_size)
+            if message.messageid not in self.__to_me_ids:
+                return
         if not self._tag_blacklist.intersection(message.tags):
             self.add_tags(message, self.me_tag)
@@ -1,16 +1,10 @@
 # Copyright (c) Jens Neuhalfen <jens@neuhalfen.name>
 
 import re
-from itertools import chain
 
 from afew.filters.BaseFilter import Filter
 
 
-def _flatten(listOfLists):
-    "Flatten one level of nesting"
-    return chain.from_iterable(listOfLists)
-
-
 class PropagateTagsByRegexInThreadFilter(Filter):
     """
     This filter enables a very easy workflow where entire threads can be tagged automatically.
@@ -37,21 +31,11 @@ class PropagateTagsByRegexInThreadFilter(Filter):
 
     All matching tags ``t`` are then assigned to the new message.
     """
+    uses_thread_index = True
+    prefetch_threads = True
 
     def handle_message(self, message):
-        thread_query = 'thread:"%s"' % (message.threadid,)
-        if self._filter:
-            query = self.database.get_messages("(%s) AND (%s)" % (thread_query, self._filter))
-        else:
-            query = self.database.get_messages(thread_query)
-
-        # the query can only be iterated once, then it is exhausted
-        # https://git.notmuchmail.org/git?p=notmuch;a=blob;f=bindings/python/notmuch/messages.py;h=cae5da508f353f12cca585cb056c0b9ed92e29b3;hb=HEAD
-        messages = list(query)
-
-        # flatten  tags
-        tags_in_thread_t = {m.tags for m in messages}  # a set of Tags instances
-        tags_in_thread = set(_flatten(tags_in_thread_t))
+        tags_in_thread = self.thread_index.tags(message.threadid, self._filter)
 
         # filter tags
         propagatable_tags_in_thread = {tag for tag in tags_in_thread if self._propagate_tags.fullmatch(tag)}
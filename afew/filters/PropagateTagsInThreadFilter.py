@@ -17,16 +17,13 @@ class PropagateTagsInThreadFilter(Filter):
     filter = not is:spam
 
     """
+    uses_thread_index = True
+    prefetch_threads = True
 
     def handle_message(self, message):
+        tags_in_thread = self.thread_index.tags(message.threadid, self._filter)
         for tag in self._propagate_tags:
-            tag_query = 'thread:"%s" AND is:"%s"' % (message.threadid, tag)
-            if self._filter:
-                query = self.database.get_messages("(%s) AND (%s)" % (tag_query, self._filter))
-            else:
-                query = self.database.get_messages(tag_query)
-
-            if len(list(query)):
+            if tag in tags_in_thread:
                 self.add_tags(message, tag)
 
     def __init__(self, database, propagate_tags="", filter=None, **kwargs):
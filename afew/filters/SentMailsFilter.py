@@ -1,51 +1,67 @@
 # SPDX-License-Identifier: ISC
 # Copyright (c) Justus Winter <4winter@informatik.uni-hamburg.de>
 
-import re
-
+from afew.AddressIndex import AddressIndex, normalize_address, parse_addresses
 from afew.filters.BaseFilter import Filter
-from afew.NotmuchSettings import notmuch_settings
 
 
 class SentMailsFilter(Filter):
     message = 'Tagging all mails sent by myself to others'
-    _bare_email_re = re.compile(r"[^<]*<(?P<email>[^@<>]+@[^@<>]+)>")
 
-    def __init__(self, database, sent_tag='', to_transforms=''):
+    def __init__(self, database, sent_tag='', to_transforms='', address_batch_size=0):
         super().__init__(database)
 
-        my_addresses = set()
-        my_addresses.add(notmuch_settings.get('user', 'primary_email'))
-        if notmuch_settings.has_option('user', 'other_email'):
-            for other_email in notmuch_settings.get_list('user', 'other_email'):
-                my_addresses.add(other_email)
-
-        self.query = (
-            '(' +
-            ' OR '.join('from:"%s"' % address for address in my_addresses) +
-            ') AND NOT (' +
-            ' OR '.join('to:"%s"' % address for address in my_addresses) +
-            ')'
-        )
+        self.my_addresses = AddressIndex.mine()
+        self.address_batch_size = int(address_batch_size)
+        if not self.address_batch_size:
+            self.query = '(%s) AND NOT (%s)' % (self.my_addresses.query('from'),
+                                                self.my_addresses.query('to'))
+        self.__run_query = ''
+        self.__sent_ids = None
 
         self.sent_tag = sent_tag
         self.to_transforms = to_transforms
         if to_transforms:
             self.__email_to_tags = self.__build_email_to_tags(to_transforms)
 
+    def build_query(self, query):
+        # with batched address queries, the messages sent by me are looked
+        # up when the first message of this run is handled
+        self.__run_query = query
+        self.__sent_ids = None
+        return super().build_query(query)
+
     def handle_message(self, message):
+        if not self._is_sent_mail(message):
+            return
         if self.sent_tag:
             self.add_tags(message, self.sent_tag)
         if self.to_transforms:
+            tags = set()
             for header in ('To', 'Cc', 'Bcc'):
                 try:
-                    email = self.__get_bare_email(message.header(header))
+                    addresses = parse_addresses(message.header(header))
                 except LookupError:
-                    email = ''
-                for tag in self.__pick_tags(email):
-                    self.add_tags(message, tag)
-                else:
-                    break
+                    continue
+                for address in addresses:
+                    tags.update(self.__email_to_tags.get(address, ()))
+            self.add_tags(message, *tags)
+
+    def _is_sent_mail(self, message):
+        '''
+        Returns whether a message handled in this run was sent by me to
+        others; without batched address queries, the query of the filter
+        only finds such messages.
+        '''
+        if not self.address_batch_size:
+            return True
+        if self.__sent_ids is None:
+            from_me = self.my_addresses.message_ids(
+                self.database, 'from', self.__run_query, self.address_batch_size)
+            to_me = self.my_addresses.message_ids(
+                self.database, 'to', self.__run_query, self.address_batch_size)
+            self.__sent_ids = from_me - to_me
+        return message.messageid in self.__sent_ids
 
     def __build_email_to_tags(self, to_transforms):
         email_to_tags = dict()
@@ -53,27 +69,13 @@ class SentMailsFilter(Filter):
         for rule in to_transforms.split():
             if ':' in rule:
                 email, tags = rule.split(':')
-                email_to_tags[email] = tuple(tags.split(';'))
+                tags = tuple(tags.split(';'))
             else:
                 email = rule
-                email_to_tags[email] = tuple()
-
-        return email_to_tags
-
-    def __get_bare_email(self, email):
-        if '<' not in email:
-            return email
-        else:
-            match = self._bare_email_re.search(email)
-            return match.group('email')
-
-    def __pick_tags(self, email):
-        if email in self.__email_to_tags:
-            tags = self.__email_to_tags[email]
-            if tags:
-                return tags
-            else:
+                tags = ()
+            if not tags:
                 user_part, domain_part = email.split('@')
-                return (user_part,)
+                tags = (user_part,)
+            email_to_tags[normalize_address(email)] = tags
 
-        return tuple()
+        return email_to_tags
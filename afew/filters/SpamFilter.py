@@ -7,7 +7,9 @@ from afew.filters.HeaderMatchingFilter import HeaderMatchingFilter
 class SpamFilter(HeaderMatchingFilter):
     message = 'Tagging spam messages'
     header = 'X-Spam-Flag'
-    pattern = 'YES'
+    # a whole word, so that notmuch can find the candidates if it indexes
+    # the header
+    pattern = r'^YES\b'
 
     def __init__(self, database, tags='+spam', spam_tag=None, **kwargs):
         if spam_tag is not None:
@@ -1,32 +1,57 @@
 # SPDX-License-Identifier: ISC
 # Copyright (c) Justus Winter <4winter@informatik.uni-hamburg.de>
 
+import contextlib
 import sys
 
-from afew.MailMover import MailMover
+from afew.FilterChain import FilterChain
+from afew.MailMover import MailMover, read_plan, write_plan
 
 try:
-    from .files import watch_for_new_files, quick_find_dirs_hack
+    from .files import watch_for_new_files, find_directories, WatchLimitError
 except ImportError:
     watch_available = False
 else:
     watch_available = True
 
 
+def open_plan(path, mode):
+    if path == '-':
+        return contextlib.nullcontext(sys.stdout if 'w' in mode else sys.stdin)
+    return open(path, mode)
+
+
 def main(options, database, query_string):
     if options.tag:
-        for filter_ in options.enable_filters:
-            filter_.run(query_string)
-            filter_.commit(options.dry_run)
+        chain = FilterChain(database, options.enable_filters)
+        chain.run(query_string, dry_run=options.dry_run)
+        chain.commit(options.dry_run)
     elif options.watch:
         if not watch_available:
             sys.exit('Sorry, this feature requires Linux and pyinotify')
-        watch_for_new_files(options, database,
-                            quick_find_dirs_hack(database.db_path))
+        try:
+            watch_for_new_files(options, database,
+                                find_directories(database.db_path),
+                                daemonize=options.daemonize)
+        except WatchLimitError as e:
+            sys.exit(str(e))
     elif options.move_mails:
-        for maildir, rules in options.mail_move_rules.items():
-            mover = MailMover(options.mail_move_age, options.mail_move_rename, options.dry_run, options.notmuch_args)
-            mover.move(maildir, rules)
-            mover.close()
+        mover = MailMover(options.mail_move_age, options.mail_move_rename, options.dry_run, options.notmuch_args,
+                          use_notmuch_new=options.mail_move_use_notmuch_new,
+                          workers=options.mail_move_workers,
+                          workers_per_destination=options.mail_move_workers_per_destination)
+        if options.apply_plan:
+            try:
+                with open_plan(options.apply_plan, 'r') as plan_file:
+                    planned = read_plan(plan_file)
+            except (OSError, ValueError) as e:
+                sys.exit('Could not read move plan: {}'.format(e))
+            mover.apply_plan(planned)
+        else:
+            planned = mover.move_all(options.mail_move_rules)
+            if options.write_plan:
+                with open_plan(options.write_plan, 'w') as plan_file:
+                    write_plan(planned, plan_file)
+        mover.close()
     else:
         sys.exit('Weird... please file a bug containing your command line.')
@@ -0,0 +1,113 @@
+# SPDX-License-Identifier: ISC
+"""Test suite for AddressIndex and the filters using it.
+"""
+import unittest
+from unittest import mock
+
+from afew.AddressIndex import AddressIndex, parse_addresses
+from afew.NotmuchSettings import notmuch_settings
+
+
+def _make_message(message_id, **headers):
+    message = mock.Mock()
+    message.messageid = message_id
+    message.tags = set()
+    message.header.side_effect = lambda name: headers[name.lower()]
+    return message
+
+
+class _SettingsTestCase(unittest.TestCase):
+    def setUp(self):
+        notmuch_settings['user'] = {'primary_email': 'Me@Example.org',
+                                    'other_email': 'alias@example.org; other@example.net'}
+        self.addCleanup(notmuch_settings.remove_section, 'user')
+
+
+class TestAddressIndex(_SettingsTestCase):
+    """Test suite for `AddressIndex`.
+    """
+    def test_parse_addresses(self):
+        self.assertEqual(parse_addresses('"Doe, Jane" <Jane@Example.org>, bob@example.org, undisclosed-recipients:;'),
+                         ('jane@example.org', 'bob@example.org'))
+
+    def test_mine(self):
+        index = AddressIndex.mine()
+        self.assertIn('me@example.ORG', index)
+        self.assertTrue(index.any_in('Someone <someone@example.org>, <ALIAS@example.org>'))
+        self.assertFalse(index.any_in('Someone <someone@example.org>'))
+        self.assertEqual(index.query('to'),
+                         'to:"alias@example.org" OR to:"me@example.org" OR to:"other@example.net"')
+
+    def test_batches(self):
+        index = AddressIndex.mine()
+        self.assertEqual(index.queries('from', 2),
+                         ['from:"alias@example.org" OR from:"me@example.org"',
+                          'from:"other@example.net"'])
+
+        database = mock.Mock()
+        database.get_messages.side_effect = [[mock.Mock(messageid='a')],
+                                             [mock.Mock(messageid='b')]]
+        self.assertSetEqual(index.message_ids(database, 'from', 'tag:new', 2), {'a', 'b'})
+        database.get_messages.assert_called_with('(tag:new) AND (from:"other@example.net")')
+
+
+class TestSentMailsFilter(_SettingsTestCase):
+    """Test suite for `SentMailsFilter`.
+    """
+    def test_to_transforms_use_all_recipients(self):
+        from afew.filters.SentMailsFilter import SentMailsFilter
+
+        sent_filter = SentMailsFilter(mock.Mock(), sent_tag='sent',
+                                      to_transforms='List@lists.example.org a@example.org:x;y')
+        message = _make_message('a', to='Bob <bob@example.org>, list@LISTS.example.org',
+                                cc='<a@example.org>')
+        sent_filter.handle_message(message)
+
+        self.assertSetEqual(sent_filter.get_changes()['a'][1], {'sent', 'List', 'x', 'y'})
+
+    def test_batched_queries(self):
+        from afew.filters.SentMailsFilter import SentMailsFilter
+
+        database = mock.Mock()
+
+        def get_messages(query):
+            ids = ['a', 'b'] if 'from:' in query else ['b']
+            return [mock.Mock(messageid=message_id) for message_id in ids]
+        database.get_messages.side_effect = get_messages
+
+        sent_filter = SentMailsFilter(database, sent_tag='sent', address_batch_size=2)
+        self.assertIsNone(getattr(sent_filter, 'query', None))
+        self.assertEqual(sent_filter.build_query('tag:new'), 'tag:new')
+        for message_id in 'abc':
+            sent_filter.handle_message(_make_message(message_id))
+
+        self.assertListEqual(list(sent_filter.get_changes()), ['a'])
+        self.assertEqual(database.get_messages.call_count, 4)
+
+    def test_archive_batched(self):
+        from afew.filters.ArchiveSentMailsFilter import ArchiveSentMailsFilter
+
+        database = mock.Mock()
+
+        def get_messages(query):
+            ids = ['sent'] if 'from:' in query else []
+            return [mock.Mock(messageid=message_id) for message_id in ids]
+        database.get_messages.side_effect = get_messages
+        notmuch_settings['new'] = {'tags': 'new'}
+        self.addCleanup(notmuch_settings.remove_section, 'new')
+
+        archive_filter = ArchiveSentMailsFilter(database, sent_tag='sent', address_batch_size=1)
+        archive_filter.build_query('tag:new')
+        for message_id in ('sent', 'received'):
+            archive_filter.handle_message(_make_message(message_id))
+
+        self.assertDictEqual(archive_filter.get_changes(), {'sent': (False, {'sent'}, {'new'})})
+
+
+class TestMeFilter(_SettingsTestCase):
+    """Test suite for `MeFilter`.
+    """
+    def test_query(self):
+        from afew.filters.MeFilter import MeFilter
+
+        self.assertEqual(MeFilter(mock.Mock()).query, AddressIndex.mine().query('to'))
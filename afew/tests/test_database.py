@@ -0,0 +1,181 @@
+# SPDX-License-Identifier: ISC
+"""Test suite for Database.
+"""
+import unittest
+from unittest import mock
+
+import notmuch2
+
+from afew.Database import AddedMessage, Database
+
+
+def _make_message(tags):
+    message = mock.MagicMock()
+    message.tags = set(tags)
+    return message
+
+
+class TestApplyTagChanges(unittest.TestCase):
+    """Test suite for `Database.apply_tag_changes`.
+    """
+    def _apply(self, messages, changes, batch_size=0):
+        database = Database(commit_batch_size=batch_size)
+        handle = mock.MagicMock()
+        handle.find.side_effect = messages.__getitem__
+        with mock.patch.object(database, 'open', return_value=handle):
+            database.apply_tag_changes(changes)
+        return handle
+
+    def test_changes(self):
+        messages = {'a': _make_message(['new', 'x']), 'b': _make_message(['y'])}
+        self._apply(messages, {
+            'a': (False, {'inbox'}, {'new'}),
+            'b': (True, {'z'}, set()),
+        })
+
+        self.assertSetEqual(messages['a'].tags, {'inbox', 'x'})
+        self.assertSetEqual(messages['b'].tags, {'z'})
+        messages['a'].frozen.assert_called_once_with()
+
+    def test_unchanged_message_is_not_written(self):
+        messages = {'a': _make_message(['inbox'])}
+        self._apply(messages, {'a': (False, {'inbox'}, {'new'})})
+
+        messages['a'].frozen.assert_not_called()
+
+    def test_batches(self):
+        messages = dict((str(i), _make_message([])) for i in range(5))
+        handle = self._apply(messages,
+                             dict((key, (False, {'a'}, set())) for key in messages),
+                             batch_size=2)
+
+        self.assertEqual(handle.atomic.call_count, 3)
+        for message in messages.values():
+            self.assertSetEqual(message.tags, {'a'})
+
+
+class TestOpen(unittest.TestCase):
+    """Test suite for `Database.open`.
+    """
+    @mock.patch('afew.Database.time.sleep')
+    @mock.patch('afew.Database.notmuch2.Database')
+    def test_backoff(self, notmuch_database, sleep):
+        handle = mock.Mock()
+        notmuch_database.side_effect = [notmuch2.NotmuchError()] * 4 + [handle]
+
+        self.assertIs(Database().open(rw=True, retry_delay=1, max_retry_delay=4), handle)
+
+        delays = [call[0][0] for call in sleep.call_args_list]
+        self.assertEqual(len(delays), 4)
+        for delay, limit in zip(delays, (1, 2, 4, 4)):
+            self.assertTrue(limit / 2 <= delay <= limit)
+
+    @mock.patch('afew.Database.time.sleep')
+    @mock.patch('afew.Database.notmuch2.Database')
+    def test_give_up(self, notmuch_database, sleep):
+        notmuch_database.side_effect = notmuch2.NotmuchError()
+
+        with self.assertRaises(notmuch2.NotmuchError):
+            Database().open(rw=True, retry_for=0)
+        sleep.assert_not_called()
+
+
+class TestRenameMessage(unittest.TestCase):
+    """Test suite for `Database.rename_message`.
+    """
+    def test_rename(self):
+        database = Database()
+        handle = mock.MagicMock()
+        with mock.patch.object(database, 'open', return_value=handle):
+            message = database.rename_message('/mail/cur/a:2,', '/mail/cur/a:2,S')
+
+        handle.add.assert_called_once_with('/mail/cur/a:2,S')
+        handle.remove.assert_called_once_with('/mail/cur/a:2,')
+        handle.get.assert_called_with('/mail/cur/a:2,S')
+        message.tags.from_maildir_flags.assert_called_once_with()
+
+    def test_unknown_file(self):
+        database = Database()
+        handle = mock.MagicMock()
+        handle.get.side_effect = LookupError
+        with mock.patch.object(database, 'open', return_value=handle):
+            self.assertIsNone(database.rename_message('/mail/new/a', '/mail/cur/a:2,S'))
+
+        handle.add.assert_not_called()
+        handle.remove.assert_not_called()
+
+
+class _FlagSyncingTags(set):
+    def from_maildir_flags(self):
+        self.add('replied')
+
+
+class _SeenTags(set):
+    def from_maildir_flags(self):
+        self.discard('unread')
+
+
+class TestAddMessages(unittest.TestCase):
+    """Test suite for `Database.add_messages`.
+    """
+    @mock.patch('afew.Database.get_notmuch_new_tags', return_value=iter(['new', 'todo']))
+    def test_outcomes(self, get_notmuch_new_tags):
+        new, duplicate = _make_message([]), _make_message(['inbox'])
+        new.tags, duplicate.tags = _FlagSyncingTags(new.tags), _FlagSyncingTags(duplicate.tags)
+        handle = mock.MagicMock()
+        handle.add.side_effect = [(new, False), (duplicate, True), notmuch2.FileNotEmailError()]
+
+        database = Database()
+        with mock.patch.object(database, 'open', return_value=handle):
+            results = database.add_messages(['/a', '/b', '/c'], sync_maildir_flags=True)
+
+        self.assertListEqual([(result.path, result.status) for result in results],
+                             [('/a', AddedMessage.NEW), ('/b', AddedMessage.DUPLICATE),
+                              ('/c', AddedMessage.ERROR)])
+        self.assertIsInstance(results[2].error, notmuch2.FileNotEmailError)
+        handle.atomic.assert_called_once_with()
+        get_notmuch_new_tags.assert_called_once_with()
+
+        self.assertSetEqual(new.tags, {'new', 'todo', 'replied'})
+        self.assertSetEqual(duplicate.tags, {'inbox', 'replied'})
+        new.frozen.assert_called_once_with()
+        handle.add.assert_has_calls([mock.call('/a'), mock.call('/b'), mock.call('/c')])
+
+    @mock.patch('afew.Database.get_notmuch_new_tags', return_value=iter(['unread', 'inbox']))
+    def test_seen_flag_wins(self, get_notmuch_new_tags):
+        message = _make_message([])
+        message.tags = _SeenTags(message.tags)
+        handle = mock.MagicMock()
+        handle.add.return_value = (message, False)
+
+        database = Database()
+        with mock.patch.object(database, 'open', return_value=handle):
+            database.add_messages(['/mail/cur/a:2,S'], sync_maildir_flags=True)
+
+        self.assertSetEqual(message.tags, {'inbox'})
+
+    @mock.patch('afew.Database.get_notmuch_new_tags', return_value=iter([]))
+    def test_add_message_raises(self, get_notmuch_new_tags):
+        handle = mock.MagicMock()
+        handle.add.side_effect = notmuch2.FileError()
+
+        database = Database()
+        with mock.patch.object(database, 'open', return_value=handle):
+            with self.assertRaises(notmuch2.FileError):
+                database.add_message('/a')
+
+
+class TestMoveMessages(unittest.TestCase):
+    """Test suite for `Database.move_messages`.
+    """
+    def test_move(self):
+        database = Database()
+        handle = mock.MagicMock()
+        with mock.patch.object(database, 'open', return_value=handle):
+            database.move_messages([('/a', ['/b', '/c']), ('/d', ['/e'])])
+
+        handle.atomic.assert_called_once_with()
+        self.assertListEqual(handle.mock_calls[2:-1], [
+            mock.call.add('/b'), mock.call.add('/c'), mock.call.remove('/a'),
+            mock.call.add('/e'), mock.call.remove('/d'),
+        ])
@@ -1,5 +1,8 @@
 """Test suite for DKIMValidityFilter.
 """
+import os
+import shutil
+import tempfile
 import unittest
 from email.utils import make_msgid
 from unittest import mock
@@ -8,7 +11,7 @@ import dkim
 import dns.exception
 
 from afew.Database import Database
-from afew.filters.DKIMValidityFilter import DKIMValidityFilter
+from afew.filters.DKIMValidityFilter import DKIMValidityFilter, DKIMVerifyError
 
 
 class _AddTags:  # pylint: disable=too-few-public-methods
@@ -22,14 +25,14 @@ class _AddTags:  # pylint: disable=too-few-public-methods
         self._tags.update(tags)
 
 
-def _make_dkim_validity_filter():
+def _make_dkim_validity_filter(**kwargs):
     """Make `DKIMValidityFilter` with mocked `DKIMValidityFilter.add_tags`
     method, so in tests we can easily check what tags were added by filter
     without fiddling with db.
     """
     tags = set()
     add_tags = _AddTags(tags)
-    dkim_filter = DKIMValidityFilter(Database())
+    dkim_filter = DKIMValidityFilter(Database(), **kwargs)
     dkim_filter.add_tags = add_tags
     return dkim_filter, tags
 
@@ -67,9 +70,9 @@ class TestDKIMValidityFilter(unittest.TestCase):
         message = _make_message()
         message.header.return_value = False
 
-        with mock.patch('afew.filters.DKIMValidityFilter.dkim.verify') \
-                as dkim_verify:
-            dkim_verify.return_value = True
+        with mock.patch('afew.filters.DKIMValidityFilter.dkim.DKIM') \
+                as dkim_class:
+            dkim_class.return_value.verify.return_value = True
             dkim_filter.handle_message(message)
 
         self.assertSetEqual(tags, set())
@@ -84,9 +87,9 @@ class TestDKIMValidityFilter(unittest.TestCase):
         message = _make_message()
         message.filenames.return_value = ['a', 'b', 'c']
 
-        with mock.patch('afew.filters.DKIMValidityFilter.dkim.verify') \
-                as dkim_verify:
-            dkim_verify.return_value = True
+        with mock.patch('afew.filters.DKIMValidityFilter.dkim.DKIM') \
+                as dkim_class:
+            dkim_class.return_value.verify.return_value = True
             dkim_filter.handle_message(message)
 
         self.assertSetEqual(tags, {'dkim-ok'})
@@ -101,9 +104,9 @@ class TestDKIMValidityFilter(unittest.TestCase):
         message = _make_message()
         message.filenames.return_value = ['a', 'b', 'c']
 
-        with mock.patch('afew.filters.DKIMValidityFilter.dkim.verify') \
-                as dkim_verify:
-            dkim_verify.return_value = False
+        with mock.patch('afew.filters.DKIMValidityFilter.dkim.DKIM') \
+                as dkim_class:
+            dkim_class.return_value.verify.return_value = False
             dkim_filter.handle_message(message)
 
         self.assertSetEqual(tags, {'dkim-fail'})
@@ -118,9 +121,9 @@ class TestDKIMValidityFilter(unittest.TestCase):
         message = _make_message()
         message.filenames.return_value = ['a', 'b', 'c']
 
-        with mock.patch('afew.filters.DKIMValidityFilter.dkim.verify') \
-                as dkim_verify:
-            dkim_verify.side_effect = [True, False, True]
+        with mock.patch('afew.filters.DKIMValidityFilter.dkim.DKIM') \
+                as dkim_class:
+            dkim_class.return_value.verify.side_effect = [True, False, True]
             dkim_filter.handle_message(message)
 
         self.assertSetEqual(tags, {'dkim-fail'})
@@ -134,9 +137,9 @@ class TestDKIMValidityFilter(unittest.TestCase):
         dkim_filter, tags = _make_dkim_validity_filter()
         message = _make_message()
 
-        with mock.patch('afew.filters.DKIMValidityFilter.dkim.verify') \
-                as dkim_verify:
-            dkim_verify.side_effect = dns.resolver.NoNameservers()
+        with mock.patch('afew.filters.DKIMValidityFilter.dkim.DKIM') \
+                as dkim_class:
+            dkim_class.return_value.verify.side_effect = dns.resolver.NoNameservers()
             dkim_filter.handle_message(message)
 
         self.assertSetEqual(tags, {'dkim-fail'})
@@ -150,9 +153,90 @@ class TestDKIMValidityFilter(unittest.TestCase):
         dkim_filter, tags = _make_dkim_validity_filter()
         message = _make_message()
 
-        with mock.patch('afew.filters.DKIMValidityFilter.dkim.verify') \
-                as dkim_verify:
-            dkim_verify.side_effect = dkim.KeyFormatError()
+        with mock.patch('afew.filters.DKIMValidityFilter.dkim.DKIM') \
+                as dkim_class:
+            dkim_class.return_value.verify.side_effect = dkim.KeyFormatError()
             dkim_filter.handle_message(message)
 
         self.assertSetEqual(tags, {'dkim-fail'})
+
+    def test_dkim_worker_pool(self):
+        """Test messages verified in the worker pool get their tags once the
+        filter has finished.
+        """
+        tagged = {}
+
+        def add_tags(message, *tags):
+            tagged.setdefault(message.messageid, set()).update(tags)
+
+        dkim_filter, _ = _make_dkim_validity_filter(workers='4')
+        dkim_filter.add_tags = add_tags
+        messages = [_make_message() for _ in range(20)]
+        messages[3].filenames.return_value = ['a', 'bad']
+        messages[5].filenames.return_value = ['error']
+
+        def verify_dkim(path, dnsfunc=None):
+            if path == 'error':
+                raise DKIMVerifyError('key format error')
+            return path != 'bad'
+
+        with mock.patch('afew.filters.DKIMValidityFilter.verify_dkim',
+                        side_effect=verify_dkim):
+            for message in messages:
+                dkim_filter.handle_message(message)
+            # the messages are freed when the query is done
+            message_ids = [message.messageid for message in messages]
+            for message in messages:
+                type(message).messageid = mock.PropertyMock(side_effect=RuntimeError('freed'))
+            dkim_filter.finish()
+
+        self.assertEqual(len(tagged), 20)
+        self.assertSetEqual(tagged[message_ids[3]], {'dkim-fail'})
+        self.assertSetEqual(tagged[message_ids[5]], {'dkim-fail'})
+        self.assertSetEqual(tagged[message_ids[0]], {'dkim-ok'})
+
+    def test_dkim_verdict_cache(self):
+        """Test an unchanged file is verified only once across runs, unless
+        a refresh is requested.
+        """
+        state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, state_dir)
+        path = os.path.join(state_dir, 'message')
+        with open(path, 'wb') as message_file:
+            message_file.write(b'message')
+        message = _make_message()
+        message.filenames.return_value = [path]
+
+        with mock.patch('afew.filters.DKIMValidityFilter.user_state_dir', state_dir), \
+                mock.patch('afew.filters.DKIMValidityFilter.dkim.DKIM') as dkim_class:
+            dkim_class.return_value.verify.return_value = True
+            for kwargs in ({}, {}, {'verdict_refresh': 'true'}):
+                dkim_filter, tags = _make_dkim_validity_filter(dns_cache='false', **kwargs)
+                dkim_filter.handle_message(message)
+                dkim_filter.finish()
+                self.assertSetEqual(tags, {'dkim-ok'})
+
+        self.assertEqual(dkim_class.return_value.verify.call_count, 2)
+
+    def test_dkim_dns_failure_not_cached(self):
+        """Test a file whose key could not be looked up is verified again in
+        the next run, while an invalid signature is remembered.
+        """
+        state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, state_dir)
+        path = os.path.join(state_dir, 'message')
+        with open(path, 'wb') as message_file:
+            message_file.write(b'message')
+        message = _make_message()
+        message.filenames.return_value = [path]
+
+        for error, call_count in ((dkim.DnsTimeoutError(), 2), (dkim.ValidationError(), 1)):
+            with mock.patch('afew.filters.DKIMValidityFilter.user_state_dir', state_dir), \
+                    mock.patch('afew.filters.DKIMValidityFilter.dkim.DKIM') as dkim_class:
+                dkim_class.return_value.verify.side_effect = error
+                for _ in range(2):
+                    dkim_filter, tags = _make_dkim_validity_filter(dns_cache='false')
+                    dkim_filter.handle_message(message)
+                    dkim_filter.finish()
+                    self.assertSetEqual(tags, {'dkim-fail'})
+            self.assertEqual(dkim_class.return_value.verify.call_count, call_count)
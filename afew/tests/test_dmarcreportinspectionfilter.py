@@ -0,0 +1,136 @@
+# SPDX-License-Identifier: ISC
+"""Test suite for DMARCReportInspectionFilter.
+"""
+import email.message
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+from email.utils import make_msgid
+from unittest import mock
+
+from afew.filters.BaseFilter import MessageRef
+from afew.filters.DMARCReportInspectionFilter import \
+    DMARCInspectionError, DMARCReportInspectionFilter, read_auth_results
+
+RECORD = '''
+  <record>
+    <auth_results>
+      <dkim><domain>example.org</domain><result>{dkim}</result></dkim>
+      <spf><domain>example.org</domain><result>{spf}</result></spf>
+    </auth_results>
+  </record>'''
+
+
+def _make_report(*records):
+    """Make DMARC aggregate report with a record for each (dkim, spf)
+    result pair.
+    """
+    return ('<?xml version="1.0" encoding="UTF-8" ?>\n<feedback>'
+            '<report_metadata><org_name>example.org</org_name></report_metadata>' +
+            ''.join(RECORD.format(dkim=dkim, spf=spf) for dkim, spf in records) +
+            '</feedback>').encode('UTF-8')
+
+
+def _zip(name, data):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as zip_file:
+        zip_file.writestr(name, data)
+    return buffer.getvalue()
+
+
+class TestReadAuthResults(unittest.TestCase):
+    """Test suite for `read_auth_results`.
+    """
+    def test_all_pass(self):
+        report = _make_report(('pass', 'pass'), ('pass', 'none'))
+        self.assertEqual(read_auth_results(report), {'dkim': True, 'spf': True})
+
+    def test_some_fail(self):
+        report = _make_report(('pass', 'pass'), ('fail', 'pass'))
+        self.assertEqual(read_auth_results(report), {'dkim': False, 'spf': True})
+
+    def test_empty_result(self):
+        report = _make_report(('pass', ''))
+        self.assertEqual(read_auth_results(report), {'dkim': True, 'spf': False})
+
+    def test_parse_error(self):
+        with self.assertRaises(DMARCInspectionError):
+            read_auth_results(b'<feedback><record>')
+
+
+class TestDMARCReportInspectionFilter(unittest.TestCase):
+    """Test suite for `DMARCReportInspectionFilter`.
+    """
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.test_dir)
+
+    def _make_message(self, *attachments):
+        """Make mock message backed by a file with the given (data,
+        maintype, subtype, filename) attachments.
+        """
+        mail = email.message.EmailMessage()
+        mail['Subject'] = 'Report Domain: example.org'
+        mail.set_content('report attached')
+        for data, maintype, subtype, filename in attachments:
+            mail.add_attachment(data, maintype=maintype, subtype=subtype,
+                                filename=filename)
+        path = os.path.join(self.test_dir, 'message')
+        with open(path, 'wb') as message_file:
+            message_file.write(mail.as_bytes())
+
+        message = mock.Mock()
+        message.messageid = make_msgid()
+        message.path = path
+        message.header.return_value = mail['Subject']
+        return message
+
+    def _tags(self, message):
+        dmarc_filter = DMARCReportInspectionFilter(mock.Mock())
+        dmarc_filter.add_tags = mock.Mock()
+        dmarc_filter.handle_message(message)
+        if not dmarc_filter.add_tags.called:
+            return None
+        return set(dmarc_filter.add_tags.call_args[0][1:])
+
+    def test_zip_gzip_and_xml(self):
+        message = self._make_message(
+            (_zip('a.xml', _make_report(('pass', 'pass'))), 'application', 'zip', 'a.zip'),
+            (gzip.compress(_make_report(('pass', 'fail'))), 'application', 'gzip', 'b.xml.gz'),
+            (_make_report(('pass', 'pass')), 'application', 'xml', 'c.xml'),
+        )
+        self.assertSetEqual(self._tags(message),
+                            {'dmarc', 'dmarc/dkim-ok', 'dmarc/spf-fail'})
+
+    def test_bad_gzip_is_not_tagged(self):
+        message = self._make_message(
+            (b'not gzip', 'application', 'gzip', 'b.xml.gz'),
+        )
+        self.assertIsNone(self._tags(message))
+
+    def test_worker_pool(self):
+        dmarc_filter = DMARCReportInspectionFilter(mock.Mock(), workers='2')
+        dmarc_filter.add_tags = mock.Mock()
+        messages = []
+        for result in ('pass', 'fail'):
+            message = self._make_message(
+                (_make_report((result, 'pass')), 'application', 'xml', 'c.xml'))
+            new_path = os.path.join(self.test_dir, result)
+            os.rename(message.path, new_path)
+            message.path = new_path
+            messages.append(message)
+            dmarc_filter.handle_message(message)
+        # the messages are freed when the query is done
+        message_ids = [message.messageid for message in messages]
+        for message in messages:
+            type(message).messageid = mock.PropertyMock(side_effect=RuntimeError('freed'))
+        dmarc_filter.finish()
+
+        dmarc_filter.add_tags.assert_has_calls([
+            mock.call(MessageRef(message_ids[0]), 'dmarc', 'dmarc/dkim-ok', 'dmarc/spf-ok'),
+            mock.call(MessageRef(message_ids[1]), 'dmarc', 'dmarc/dkim-fail', 'dmarc/spf-ok'),
+        ])
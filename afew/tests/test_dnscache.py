@@ -0,0 +1,107 @@
+# SPDX-License-Identifier: ISC
+"""Test suite for DNSCache.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import dkim
+import dns.exception
+import dns.resolver
+
+from afew.DNSCache import DNSCache
+
+
+class TestDNSCache(unittest.TestCase):
+    """Test suite for `DNSCache`.
+    """
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.test_dir, 'state', 'dkim-keys.json')
+        self.now = 1000.0
+        patcher = mock.patch('afew.DNSCache.time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.test_dir)
+
+    def _resolve(self, cache, records):
+        """Patch the DNS lookup to answer from `records` (name -> (value,
+        ttl)), or fail if `records` is an exception.
+        """
+        def resolve(name, timeout):
+            if isinstance(records, Exception):
+                raise records
+            return records[name]
+        return mock.patch.object(cache, '_resolve', side_effect=resolve)
+
+    def test_ttl(self):
+        cache = DNSCache()
+        with self._resolve(cache, {'a': (b'key', 60)}) as resolve:
+            self.assertEqual(cache.get_txt(b'a'), b'key')
+            self.now += 30
+            self.assertEqual(cache.get_txt(b'a'), b'key')
+            self.assertEqual(resolve.call_count, 1)
+            self.now += 60
+            self.assertEqual(cache.get_txt(b'a'), b'key')
+            self.assertEqual(resolve.call_count, 2)
+
+    def test_lru_eviction(self):
+        cache = DNSCache(max_entries=2)
+        records = {'a': (b'1', 60), 'b': (b'2', 60), 'c': (None, 60)}
+        with self._resolve(cache, records) as resolve:
+            cache.get_txt(b'a')
+            cache.get_txt(b'b')
+            cache.get_txt(b'a')
+            cache.get_txt(b'c')
+            self.assertEqual(resolve.call_count, 3)
+            cache.get_txt(b'a')
+            self.assertEqual(resolve.call_count, 3)
+            cache.get_txt(b'b')
+            self.assertEqual(resolve.call_count, 4)
+
+    def test_persistence(self):
+        cache = DNSCache(self.path)
+        with self._resolve(cache, {'a': (b'key', 60), 'b': (None, 60)}):
+            cache.get_txt(b'a')
+            cache.get_txt(b'b')
+        cache.save()
+
+        cache = DNSCache(self.path)
+        with self._resolve(cache, {}) as resolve:
+            self.assertEqual(cache.get_txt(b'a'), b'key')
+            self.assertIsNone(cache.get_txt(b'b'))
+            resolve.assert_not_called()
+
+    def test_damaged_file(self):
+        os.makedirs(os.path.dirname(self.path))
+        for contents in ('{"a": ["a", null, 2000]}', '[["a", "not base64!", 2000]]',
+                         '[["a", null]]', '[[["a"], null, 2000]]', '[["a", null, "soon"]]'):
+            with open(self.path, 'w') as cache_file:
+                cache_file.write(contents)
+            cache = DNSCache(self.path)
+            with self._resolve(cache, {'a': (b'key', 60)}) as resolve:
+                self.assertEqual(cache.get_txt(b'a'), b'key', contents)
+                resolve.assert_called_once_with('a', 5)
+
+    def test_offline(self):
+        cache = DNSCache(self.path, offline=True)
+        with self._resolve(cache, {'a': (b'key', 60)}):
+            cache.get_txt(b'a')
+        self.now += 120
+
+        with self._resolve(cache, dns.exception.Timeout()):
+            self.assertEqual(cache.get_txt(b'a'), b'key')
+            with self.assertRaises(dkim.DnsTimeoutError):
+                cache.get_txt(b'b')
+
+    def test_lookup_failure(self):
+        cache = DNSCache()
+        with self._resolve(cache, {'a': (b'key', 60)}):
+            cache.get_txt(b'a')
+        self.now += 120
+
+        with self._resolve(cache, dns.resolver.NoNameservers()):
+            with self.assertRaises(dkim.DnsTimeoutError):
+                cache.get_txt(b'a')
@@ -0,0 +1,202 @@
+# SPDX-License-Identifier: ISC
+"""Test suite for watch mode.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import pyinotify
+
+from afew.Database import AddedMessage
+from afew.files import EventHandler, WatchLimitError, add_watches, find_directories
+
+
+def _make_event(pathname, src_pathname=None, is_dir=False):
+    event = mock.Mock(spec=['pathname', 'src_pathname', 'dir'])
+    event.pathname = pathname
+    event.dir = is_dir
+    if src_pathname is None:
+        del event.src_pathname
+    else:
+        event.src_pathname = src_pathname
+    return event
+
+
+class TestEventHandler(unittest.TestCase):
+    """Test suite for `EventHandler`.
+    """
+    def setUp(self):
+        self.database = mock.MagicMock()
+        self.database.add_messages.side_effect = self._add_messages
+        self.options = mock.Mock(enable_filters=[], dry_run=False)
+
+    @staticmethod
+    def _add_messages(paths, sync_maildir_flags=False):
+        return [AddedMessage(path, AddedMessage.NEW, mock.Mock(messageid='<{}>'.format(path)), None)
+                for path in paths]
+
+    def _added_paths(self):
+        return [path for call in self.database.add_messages.call_args_list for path in call[0][0]]
+
+    def test_batch_is_processed_in_one_session(self):
+        handler = EventHandler(self.options, self.database, batch_window=60, batch_size=10)
+        with mock.patch('afew.files.FilterChain') as chain:
+            handler.process_IN_MOVED_TO(_make_event('/mail/new/a'))
+            handler.process_IN_MOVED_TO(_make_event('/mail/cur/b', '/mail/new/b'))
+            handler.process_IN_DELETE(_make_event('/mail/cur/c'))
+            handler.flush_if_due()
+            self.database.add_messages.assert_not_called()
+
+            handler.flush()
+
+        self.database.rename_message.assert_called_once_with('/mail/new/b', '/mail/cur/b')
+        self.database.remove_message.assert_called_once_with('/mail/cur/c')
+        self.database.open.return_value.atomic.assert_called_once_with()
+        self.database.close.assert_not_called()
+        chain.return_value.run.assert_called_once_with('id:"</mail/new/a>"', dry_run=False)
+        chain.return_value.commit.assert_called_once_with(False)
+
+    def test_renames_are_combined(self):
+        handler = EventHandler(self.options, self.database, batch_window=60, batch_size=10)
+        handler.process_IN_MOVED_TO(_make_event('/mail/cur/a', '/mail/new/a'))
+        handler.process_IN_MOVED_TO(_make_event('/mail/cur/a:2,S', '/mail/cur/a'))
+        handler.process_IN_MOVED_TO(_make_event('/mail/cur/a:2,RS', '/mail/cur/a:2,S'))
+        handler.process_IN_MOVED_TO(_make_event('/mail/cur/b:2,S', '/mail/cur/b'))
+        handler.process_IN_DELETE(_make_event('/mail/cur/b:2,S'))
+        with mock.patch('afew.files.FilterChain') as chain:
+            handler.flush()
+
+        self.database.rename_message.assert_called_once_with('/mail/new/a', '/mail/cur/a:2,RS')
+        self.database.remove_message.assert_called_once_with('/mail/cur/b')
+        self.assertListEqual(self._added_paths(), [])
+        chain.assert_not_called()
+
+    def test_rename_of_unknown_file_is_new_mail(self):
+        self.database.rename_message.return_value = None
+        handler = EventHandler(self.options, self.database, batch_window=60, batch_size=10)
+        handler.process_IN_MOVED_TO(_make_event('/mail/cur/a:2,S', '/mail/new/a'))
+        with mock.patch('afew.files.FilterChain') as chain:
+            handler.flush()
+
+        self.database.add_messages.assert_called_once_with(['/mail/cur/a:2,S'], sync_maildir_flags=True)
+        chain.return_value.run.assert_called_once_with('id:"</mail/cur/a:2,S>"', dry_run=False)
+
+    def test_new_file_renamed_in_same_batch(self):
+        handler = EventHandler(self.options, self.database, batch_window=60, batch_size=10)
+        handler.process_IN_MOVED_TO(_make_event('/mail/new/a'))
+        handler.process_IN_MOVED_TO(_make_event('/mail/cur/a:2,S', '/mail/new/a'))
+        handler.process_IN_MOVED_TO(_make_event('/mail/new/b'))
+        handler.process_IN_DELETE(_make_event('/mail/new/b'))
+        with mock.patch('afew.files.FilterChain') as chain:
+            handler.flush()
+
+        self.database.rename_message.assert_not_called()
+        self.database.remove_message.assert_not_called()
+        self.database.add_messages.assert_called_once_with(['/mail/cur/a:2,S'], sync_maildir_flags=True)
+        chain.return_value.run.assert_called_once_with('id:"</mail/cur/a:2,S>"', dry_run=False)
+
+    def test_full_batch_is_processed(self):
+        handler = EventHandler(self.options, self.database, batch_window=60, batch_size=2)
+        with mock.patch('afew.files.FilterChain') as chain:
+            for name in 'abc':
+                handler.process_IN_MOVED_TO(_make_event('/mail/new/' + name))
+
+        self.assertEqual(chain.return_value.run.call_count, 1)
+        self.assertListEqual(self._added_paths(), ['/mail/new/a', '/mail/new/b'])
+
+    def test_window_and_idle_release(self):
+        handler = EventHandler(self.options, self.database, batch_window=0, batch_size=10,
+                               idle_release=0)
+        with mock.patch('afew.files.FilterChain') as chain:
+            handler.process_IN_MOVED_TO(_make_event('/mail/new/a'))
+            handler.flush_if_due()
+            chain.return_value.run.assert_called_once_with('id:"</mail/new/a>"', dry_run=False)
+            self.database.close.assert_not_called()
+
+            handler.flush_if_due()
+            self.database.close.assert_called_once_with()
+
+            handler.flush_if_due()
+            self.database.close.assert_called_once_with()
+
+    def test_new_directory(self):
+        test_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, test_dir)
+        folder = os.path.join(test_dir, 'Lists')
+        for subdirectory in ('cur', 'new', 'tmp'):
+            os.makedirs(os.path.join(folder, subdirectory))
+        open(os.path.join(folder, 'new', 'mail'), 'w').close()
+        open(os.path.join(folder, 'tmp', 'partial'), 'w').close()
+
+        watch_manager = mock.Mock()
+        handler = EventHandler(self.options, self.database, batch_window=60, batch_size=10,
+                               watch_manager=watch_manager)
+        handler.process_IN_CREATE(_make_event(folder, is_dir=True))
+
+        self.assertSetEqual(
+            set(call[0][0] for call in watch_manager.add_watch.call_args_list),
+            {folder, os.path.join(folder, 'cur'), os.path.join(folder, 'new')})
+        with mock.patch('afew.files.FilterChain'):
+            handler.flush()
+        self.assertListEqual(self._added_paths(), [os.path.join(folder, 'new', 'mail')])
+
+        handler.process_IN_CREATE(_make_event(os.path.join(test_dir, '.notmuch'), is_dir=True))
+        handler.process_IN_CREATE(_make_event(os.path.join(test_dir, '.notmuch', 'xapian.compact'),
+                                              is_dir=True))
+        self.assertEqual(watch_manager.add_watch.call_count, 3)
+
+        watch_manager.get_wd.return_value = 7
+        handler.process_IN_MOVED_FROM(_make_event(folder, is_dir=True))
+        watch_manager.rm_watch.assert_called_once_with(7, rec=True)
+
+
+class TestAddWatches(unittest.TestCase):
+    """Test suite for `add_watches`.
+    """
+    def test_watch_limit(self):
+        watch_manager = mock.Mock()
+        watch_manager.add_watch.side_effect = [
+            {'/a': 1},
+            pyinotify.WatchManagerError('add_watch: cannot watch /b WD=-1, Errno=No such file or directory (ENOENT)', {}),
+            {'/c': 2},
+            pyinotify.WatchManagerError('add_watch: cannot watch /d WD=-1, Errno=No space left on device (ENOSPC)', {}),
+        ]
+
+        with self.assertRaisesRegex(WatchLimitError, 'max_user_watches'):
+            add_watches(watch_manager, ['/a', '/b', '/c', '/d'])
+        self.assertEqual(add_watches(watch_manager, []), 0)
+
+
+class TestFindDirectories(unittest.TestCase):
+    """Test suite for `find_directories`.
+    """
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.test_dir)
+        for folder in ('INBOX', 'Archive/2024', 'Archive/2025'):
+            for subdirectory in ('cur', 'new', 'tmp'):
+                os.makedirs(os.path.join(self.test_dir, folder, subdirectory))
+        os.makedirs(os.path.join(self.test_dir, '.notmuch', 'xapian'))
+        os.symlink(os.path.join(self.test_dir, 'INBOX'), os.path.join(self.test_dir, 'link'))
+        open(os.path.join(self.test_dir, 'INBOX', 'cur', 'mail'), 'w').close()
+
+    def test_find_directories(self):
+        expected = {self.test_dir}
+        for folder in ('INBOX', 'Archive', 'Archive/2024', 'Archive/2025'):
+            expected.add(os.path.join(self.test_dir, folder))
+            if folder != 'Archive':
+                expected.add(os.path.join(self.test_dir, folder, 'cur'))
+                expected.add(os.path.join(self.test_dir, folder, 'new'))
+
+        for workers in (1, 4):
+            directories = list(find_directories(self.test_dir, workers=workers))
+            self.assertEqual(len(directories), len(expected))
+            self.assertSetEqual(set(directories), expected)
+
+    def test_stop_early(self):
+        directories = find_directories(self.test_dir)
+        self.assertEqual(next(directories), self.test_dir)
+        next(directories)
+        directories.close()
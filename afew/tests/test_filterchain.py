@@ -0,0 +1,178 @@
+# SPDX-License-Identifier: ISC
+"""Test suite for FilterChain.
+"""
+import unittest
+from unittest import mock
+
+from afew.FilterChain import FilterChain, TagChanges
+from afew.QueryMatcher import QueryMatcher, UnsupportedQuery, parse
+from afew.filters.BaseFilter import Filter
+
+
+def _make_message(message_id, tags):
+    message = mock.Mock()
+    message.messageid = message_id
+    message.tags = set(tags)
+    return message
+
+
+def _make_database(messages, results=None):
+    """Make mock database, `get_messages` returns all `messages` unless the
+    query is a key of `results`, in which case the messages with the listed
+    ids are returned.
+    """
+    results = results or {}
+    by_id = {message.messageid: message for message in messages}
+
+    def get_messages(query):
+        if query in results:
+            return [by_id[message_id] for message_id in results[query]]
+        return list(messages)
+
+    database = mock.Mock()
+    database.get_messages.side_effect = get_messages
+    return database
+
+
+class TestQueryMatcher(unittest.TestCase):
+    """Test suite for `QueryMatcher`.
+    """
+    def test_parse(self):
+        self.assertEqual(parse(''), ('all',))
+        self.assertEqual(parse('tag:a AND NOT is:"b c"'),
+                         ('and', (('tag', 'a'), ('not', ('tag', 'b c')))))
+        self.assertEqual(parse('tag:a AND (folder:a folder:b OR from:x) NOT tag:c'),
+                         ('and', (('tag', 'a'), ('query', 'folder:a folder:b OR from:x'),
+                                  ('not', ('tag', 'c')))))
+        # notmuch means tag:a OR tag:b
+        with self.assertRaises(UnsupportedQuery):
+            parse('tag:a tag:b')
+
+    def test_tags_only(self):
+        lookup = mock.Mock()
+        matcher = QueryMatcher('(tag:new) AND (NOT tag:killed)', lookup)
+        self.assertTrue(matcher.matches(_make_message('a', ['new'])))
+        self.assertFalse(matcher.matches(_make_message('a', ['new', 'killed'])))
+        lookup.assert_not_called()
+
+    def test_mixed(self):
+        lookup = mock.Mock(return_value={'a'})
+        matcher = QueryMatcher('tag:new AND (from:x OR to:"y z")', lookup)
+        self.assertTrue(matcher.matches(_make_message('a', ['new'])))
+        self.assertFalse(matcher.matches(_make_message('b', ['new'])))
+        self.assertFalse(matcher.matches(_make_message('a', [])))
+        lookup.assert_called_with('from:x OR to:"y z"')
+
+    def test_unsupported(self):
+        lookup = mock.Mock(return_value={'a'})
+        matcher = QueryMatcher('tag:a XOR tag:b', lookup)
+        self.assertTrue(matcher.matches(_make_message('a', [])))
+        lookup.assert_called_with('tag:a XOR tag:b')
+
+    def test_terms_without_operator(self):
+        lookup = mock.Mock(return_value={'a'})
+        matcher = QueryMatcher('tag:a tag:b', lookup)
+        self.assertTrue(matcher.matches(_make_message('a', ['c'])))
+        lookup.assert_called_with('tag:a tag:b')
+
+
+class TestFilterChain(unittest.TestCase):
+    """Test suite for `FilterChain`.
+    """
+    def test_later_filters_see_pending_changes(self):
+        """A filter removing the new tag keeps a later filter querying for
+        new mail from seeing the message, like with separate commits.
+        """
+        message = _make_message('a', ['new'])
+        database = _make_database([message])
+        skip_inbox = Filter(database, tags=['-new', '+boss'])
+        inbox = Filter(database, tags=['+inbox'], query='tag:new')
+
+        chain = FilterChain(database, [skip_inbox, inbox])
+        chain.run('tag:new')
+        chain.commit(dry_run=False)
+
+        database.apply_tag_changes.assert_called_once_with(
+            {'a': (False, {'boss'}, {'new'})})
+        database.get_messages.assert_called_once_with('tag:new')
+
+    def test_blacklist_sees_pending_changes(self):
+        message = _make_message('a', [])
+        database = _make_database([message])
+        spam = Filter(database, tags=['+spam'])
+        inbox = Filter(database, tags=['+inbox'], tags_blacklist=['spam'])
+
+        chain = FilterChain(database, [spam, inbox])
+        chain.run('')
+        chain.commit(dry_run=False)
+
+        database.apply_tag_changes.assert_called_once_with(
+            {'a': (False, {'spam'}, set())})
+
+    def test_opaque_queries_are_looked_up_once(self):
+        messages = [_make_message('a', []), _make_message('b', [])]
+        database = _make_database(messages, {'((from:x) OR (from:x)) AND (from:x)': ['a']})
+        first = Filter(database, tags=['+x'], query='from:x')
+        second = Filter(database, tags=['+y'], query='from:x')
+
+        chain = FilterChain(database, [first, second])
+        chain.run('')
+        chain.commit(dry_run=False)
+
+        database.apply_tag_changes.assert_called_once_with(
+            {'a': (False, {'x', 'y'}, set())})
+        self.assertEqual(database.get_messages.call_count, 2)
+
+    def test_dry_run(self):
+        message = _make_message('a', [])
+        database = _make_database([message])
+
+        chain = FilterChain(database, [Filter(database, tags=['+a'])])
+        chain.run('')
+        chain.commit(dry_run=True)
+
+        database.apply_tag_changes.assert_not_called()
+
+
+class TestTagChanges(unittest.TestCase):
+    """Test suite for `TagChanges`.
+    """
+    def test_update_in_commit_order(self):
+        changes = TagChanges()
+        changes.update(False, {'a', 'b'}, {'b'})
+        self.assertSetEqual(changes.apply({'c'}), {'a', 'c'})
+        changes.update(True, {'d'}, set())
+        self.assertSetEqual(changes.apply({'c'}), {'d'})
+
+
+class _QueryingFilter(Filter):
+    """Filter doing its own queries, like filters overriding `run` may."""
+    def run(self, query):
+        self.seen = self.database.apply_tag_changes.call_count
+
+
+class TestRunOverriders(unittest.TestCase):
+    """Test suite for filters that override `Filter.run`.
+    """
+    def test_earlier_changes_are_written_first(self):
+        database = _make_database([_make_message('a', [])])
+        querying = _QueryingFilter(database)
+
+        chain = FilterChain(database, [Filter(database, tags=['+a']), querying])
+        chain.run('', dry_run=False)
+        chain.commit(dry_run=False)
+
+        self.assertEqual(querying.seen, 1)
+        database.apply_tag_changes.assert_called_once_with(
+            {'a': (False, {'a'}, set())})
+
+    def test_dry_run(self):
+        database = _make_database([_make_message('a', [])])
+        querying = _QueryingFilter(database)
+
+        chain = FilterChain(database, [Filter(database, tags=['+a']), querying])
+        with self.assertLogs('afew.FilterChain', level='WARNING'):
+            chain.run('', dry_run=True)
+        chain.commit(dry_run=True)
+
+        self.assertEqual(querying.seen, 0)
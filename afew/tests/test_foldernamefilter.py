@@ -0,0 +1,44 @@
+# SPDX-License-Identifier: ISC
+"""Test suite for FolderNameFilter.
+"""
+import unittest
+from unittest import mock
+
+from afew.filters.FolderNameFilter import FolderNameFilter
+
+
+def _make_message(*filenames):
+    message = mock.Mock()
+    message.messageid = filenames[0]
+    message.filenames.return_value = list(filenames)
+    return message
+
+
+class TestFolderNameFilter(unittest.TestCase):
+    """Test suite for `FolderNameFilter`.
+    """
+    def setUp(self):
+        self.database = mock.Mock(db_path='/mail+/')
+
+    def _tags(self, folder_filter, message):
+        folder_filter.handle_message(message)
+        return folder_filter.get_changes().get(message.messageid, (False, set(), set()))[1]
+
+    def test_tags(self):
+        folder_filter = FolderNameFilter(self.database, folder_blacklist='INBOX',
+                                         folder_transforms='Junk:spam',
+                                         folder_lowercases='true')
+        message = _make_message('/mail+/INBOX.Lists/cur/a', '/mail+/Junk/new/a')
+        self.assertSetEqual(self._tags(folder_filter, message), {'lists', 'spam'})
+
+    def test_outside_of_maildirs(self):
+        folder_filter = FolderNameFilter(self.database)
+        for filename in ('/mailx/INBOX/cur/a', '/mail+/INBOX/tmp/a'):
+            self.assertSetEqual(self._tags(folder_filter, _make_message(filename)), set())
+
+    def test_directory_tags_are_cached(self):
+        folder_filter = FolderNameFilter(self.database, folder_explicit_list='Sent')
+        for name in 'abc':
+            message = _make_message('/mail+/Sent/cur/' + name)
+            self.assertSetEqual(self._tags(folder_filter, message), {'Sent'})
+        self.assertEqual(folder_filter._FolderNameFilter__directory_tags.cache_info().misses, 1)
@@ -82,3 +82,89 @@ class TestHeaderMatchingFilter(unittest.TestCase):
         header_filter.handle_message(message)
 
         self.assertSetEqual(tags, set())
+
+
+class TestHeaderMatchingGroup(unittest.TestCase):
+    """Test suite for `HeaderMatchingGroup`.
+    """
+    def _run(self, filters, headers, tags=()):
+        from afew.FilterChain import FilterChain
+
+        message = mock.Mock()
+        message.messageid = 'a'
+        message.tags = set(tags)
+        message.header.side_effect = lambda name: headers[name]
+        database = mock.Mock()
+        database.get_messages.return_value = [message]
+
+        chain = FilterChain(database, filters)
+        chain.run('')
+        chain.commit(dry_run=False)
+        return message, database
+
+    def test_header_read_once(self):
+        database = mock.Mock()
+        filters = [HeaderMatchingFilter(database, header='List-Id', pattern='<(?P<list>foo)\\.',
+                                        tags=['+lists/{list}']),
+                   HeaderMatchingFilter(database, header='list-id', pattern='<(?P<list>bar)\\.',
+                                        tags=['+lists/{list}']),
+                   HeaderMatchingFilter(database, header='X-Spam-Flag', pattern='YES',
+                                        tags=['+spam']),
+                   HeaderMatchingFilter(database, header='List-Id', pattern='',
+                                        tags=['+lists'], tags_blacklist=['spam'])]
+
+        message, database = self._run(filters, {'List-Id': '<Bar.example.com>',
+                                                'X-Spam-Flag': 'YES'})
+
+        self.assertEqual(message.header.call_count, 2)
+        database.apply_tag_changes.assert_called_once_with(
+            {'a': (False, {'lists/bar', 'spam'}, set())})
+
+    def test_no_match(self):
+        database = mock.Mock()
+        filters = [HeaderMatchingFilter(database, header='List-Id', pattern=pattern, tags=['+x'])
+                   for pattern in ('foo', 'bar')]
+
+        message, database = self._run(filters, {'List-Id': 'baz'})
+
+        self.assertEqual(message.header.call_count, 1)
+        database.apply_tag_changes.assert_not_called()
+
+    def test_combine(self):
+        from afew.filters.HeaderMatchingFilter import HeaderMatchingGroup
+
+        screen = HeaderMatchingGroup._combine(['<(?P<a>x)>', '(?P<a>y)'])
+        self.assertTrue(screen.search('Y'))
+        self.assertIsNone(HeaderMatchingGroup._combine(['(a)\\1', 'b']))
+
+
+class TestHeaderQuery(unittest.TestCase):
+    """Test suite for pushing header patterns down into notmuch queries.
+    """
+    def setUp(self):
+        from afew.NotmuchSettings import notmuch_index_settings
+
+        notmuch_index_settings['index'] = {'header.SpamFlag': 'X-Spam-Flag',
+                                           'header.List': 'List-Id'}
+        self.addCleanup(notmuch_index_settings.remove_section, 'index')
+
+    def test_whole_words(self):
+        from afew.filters.SpamFilter import SpamFilter
+
+        self.assertEqual(SpamFilter(mock.Mock()).query, 'SpamFlag:"YES"')
+        header_filter = HeaderMatchingFilter(mock.Mock(), header='x-spam-flag', pattern='^YES$')
+        self.assertEqual(header_filter.query, 'SpamFlag:"YES"')
+        header_filter = HeaderMatchingFilter(mock.Mock(), header='list-id', pattern=r'\bafew devel\b',
+                                             query='tag:new')
+        self.assertEqual(header_filter.query, '(tag:new) AND (List:"afew devel")')
+
+    def test_not_pushed_down(self):
+        from afew.filters.ListMailsFilter import ListMailsFilter
+
+        self.assertEqual(ListMailsFilter(mock.Mock()).query, 'NOT tag:lists')
+        # could match within words, which notmuch would miss
+        for header, pattern in (('X-Other', '^YES$'), ('List-Id', 'YES'), ('List-Id', '^afew'), ('List-Id', 'devel$'),
+                                ('List-Id', '^a "b"$'), ('List-Id', '^a.b$'), ('List-Id', '^a  b$'),
+                                ('List-Id', '^%s$' % ('a' * 65))):
+            header_filter = HeaderMatchingFilter(mock.Mock(), header=header, pattern=pattern)
+            self.assertIsNone(getattr(header_filter, 'query', None), pattern)
@@ -1,13 +1,18 @@
 # SPDX-License-Identifier: ISC
 
 import email.message
+import errno
+import io
+import json
 from email.utils import make_msgid
 from freezegun import freeze_time
 import mailbox
 import os
 import shutil
 import tempfile
+import threading
 import unittest
+from unittest import mock
 import notmuch2
 
 from afew.Database import Database
@@ -121,7 +126,7 @@ class TestMailMover(unittest.TestCase):
                 create_mail('In spam, tagged archive, spam\n', self.spam, db, ['archive', 'spam']),
             ])
 
-        mover = MailMover.MailMover(quiet=True)
+        mover = MailMover.MailMover(quiet=True, journal_path=os.path.join(self.test_dir, 'journal'))
         mover.move('.inbox', self.rules['.inbox'])
         mover.move('.archive', self.rules['.archive'])
         mover.move('.spam', self.rules['.spam'])
@@ -146,7 +151,8 @@ class TestMailMover(unittest.TestCase):
 
             expect_spam = set([])
 
-        mover = MailMover.MailMover(max_age=15, quiet=True)
+        mover = MailMover.MailMover(max_age=15, quiet=True,
+                                    journal_path=os.path.join(self.test_dir, 'journal'))
         mover.move('.inbox', self.rules['.inbox'])
         mover.move('.archive', self.rules['.archive'])
         mover.move('.spam', self.rules['.spam'])
@@ -156,3 +162,237 @@ class TestMailMover(unittest.TestCase):
             self.assertEqual(expect_inbox, self.get_folder_content(db, '.inbox'))
             self.assertEqual(expect_archive, self.get_folder_content(db, '.archive'))
             self.assertEqual(expect_spam, self.get_folder_content(db, '.spam'))
+
+
+class TestMoveFile(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.test_dir)
+        self.source = self.path('source')
+        with open(self.source, 'w') as f:
+            f.write('mail')
+
+    def path(self, name):
+        return os.path.join(self.test_dir, name)
+
+    def read(self, name):
+        with open(self.path(name)) as f:
+            return f.read()
+
+    def test_rename(self):
+        from afew.MailMover import move_file
+
+        inode = os.stat(self.source).st_ino
+        move_file(self.source, [self.path('a'), self.path('b')])
+
+        self.assertFalse(os.path.exists(self.source))
+        self.assertEqual(self.read('a'), 'mail')
+        self.assertEqual(os.stat(self.path('b')).st_ino, inode)
+
+    def test_other_device(self):
+        from afew.MailMover import move_file
+
+        with mock.patch('afew.MailMover.os.rename',
+                        side_effect=OSError(errno.EXDEV, 'Invalid cross-device link')):
+            move_file(self.source, [self.path('a')])
+
+        self.assertFalse(os.path.exists(self.source))
+        self.assertEqual(self.read('a'), 'mail')
+
+    def test_rollback(self):
+        from afew.MailMover import move_file
+
+        with mock.patch('afew.MailMover.os.rename', side_effect=PermissionError()):
+            with self.assertRaises(PermissionError):
+                move_file(self.source, [self.path('a'), self.path('b')])
+
+        self.assertEqual(self.read('source'), 'mail')
+        self.assertFalse(os.path.exists(self.path('a')))
+        self.assertFalse(os.path.exists(self.path('b')))
+
+    def test_execute(self):
+        from afew.MailMover import MailMover
+
+        for workers in (1, 4):
+            os.makedirs(self.path('{}/dest'.format(workers)))
+            moves = []
+            for i in range(10):
+                moves.append((self.path('{}/{}'.format(workers, i)),
+                              [self.path('{}/dest/{}'.format(workers, i))]))
+                with open(moves[-1][0], 'w') as f:
+                    f.write('mail')
+            moves.append((self.path('{}/gone'.format(workers)), [self.path('{}/dest/gone'.format(workers))]))
+
+            mover = MailMover(journal_path=self.path('journal'), workers=workers, workers_per_destination=2)
+            results = mover.execute(moves)
+
+            self.assertEqual([(result.source, result.destinations) for result in results], moves)
+            self.assertEqual([result.error is None for result in results], [True] * 10 + [False])
+            self.assertEqual(len(os.listdir(self.path('{}/dest'.format(workers)))), 10)
+
+    def test_execute_limits_folders(self):
+        from afew.MailMover import MailMover
+
+        moves = []
+        for subdirectory in ('cur', 'new'):
+            os.makedirs(self.path('dest/' + subdirectory))
+            moves.append((self.path(subdirectory), [self.path('dest/{}/mail'.format(subdirectory))]))
+            with open(moves[-1][0], 'w') as f:
+                f.write('mail')
+
+        mover = MailMover(journal_path=self.path('journal'), workers=4, workers_per_destination=1)
+        with mock.patch('afew.MailMover.threading.BoundedSemaphore',
+                        side_effect=threading.BoundedSemaphore) as semaphore:
+            results = mover.execute(moves)
+
+        self.assertEqual([result.error for result in results], [None, None])
+        semaphore.assert_called_once_with(1)
+
+    def test_recover(self):
+        from afew.MailMover import MailMover
+        from afew.MoveJournal import MoveJournal
+
+        journal_path = self.path('journal')
+        with open(self.path('a'), 'w') as f:
+            f.write('ma')
+        MoveJournal(journal_path).record([(self.source, [self.path('a'), self.path('b')]),
+                                          (self.path('gone'), [self.path('c')])])
+
+        mover = MailMover(journal_path=journal_path)
+        self.assertTrue(mover.recover())
+
+        self.assertFalse(os.path.exists(self.source))
+        self.assertEqual(self.read('a'), 'mail')
+        self.assertEqual(self.read('b'), 'mail')
+        self.assertFalse(os.path.exists(self.path('c')))
+
+        mover.journal.clear()
+        self.assertFalse(mover.recover())
+
+    def test_index_update(self):
+        from afew.MailMover import MailMover
+
+        mover = MailMover(journal_path=self.path('journal'))
+        mover.db = mock.Mock()
+        with mock.patch('afew.MailMover.check_call') as check_call:
+            mover._MailMover__update_db([(self.source, [self.path('a')])])
+            mover.db.move_messages.assert_called_once_with([(self.source, [self.path('a')])])
+            check_call.assert_not_called()
+
+            mover.db.move_messages.side_effect = notmuch2.NotmuchError()
+            mover._MailMover__update_db([(self.source, [self.path('a')])])
+            check_call.assert_called_once_with(['notmuch', 'new'])
+
+
+class TestPlan(unittest.TestCase):
+    def _make_message(self, message_id, tags, *fnames):
+        message = mock.Mock(messageid=message_id, tags=set(tags), date=0)
+        message.header.side_effect = LookupError
+        message.filenames.return_value = [os.path.join(self.mover.db_path, fname) for fname in fnames]
+        return message
+
+    def setUp(self):
+        from afew.MailMover import MailMover
+
+        test_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, test_dir)
+        self.mover = MailMover(rename=False, journal_path=os.path.join(test_dir, 'journal'))
+        self.mover.db = mock.Mock()
+
+    def test_first_matching_rule_wins(self):
+        messages = [
+            self._make_message('a', ['spam', 'archive'], 'INBOX/cur/a', 'Sent/cur/a'),
+            self._make_message('b', ['archive'], 'INBOX/new/b'),
+            self._make_message('c', [], 'INBOX.Sub/cur/c'),
+            self._make_message('d', ['inbox'], 'Junk/cur/d'),
+        ]
+        self.mover.db.get_messages.return_value = messages
+
+        moves = self.mover.plan({
+            'INBOX': {'tag:spam': 'Junk', 'tag:archive OR tag:spam': 'Archive'},
+            'Junk': {'NOT tag:spam AND tag:inbox': 'INBOX'},
+        })
+
+        self.assertListEqual(
+            [(move.message_id, move.source, move.destination, move.folder)
+             for move in moves],
+            [('a', os.path.join(self.mover.db_path, 'INBOX/cur/a'),
+              os.path.join(self.mover.db_path, 'Junk/cur/a'), 'INBOX'),
+             ('b', os.path.join(self.mover.db_path, 'INBOX/new/b'),
+              os.path.join(self.mover.db_path, 'Archive/new/b'), 'INBOX'),
+             ('d', os.path.join(self.mover.db_path, 'Junk/cur/d'),
+              os.path.join(self.mover.db_path, 'INBOX/cur/d'), 'Junk')])
+        self.mover.db.get_messages.assert_called_once_with(
+            '((folder:"INBOX" AND ((tag:spam) OR (tag:archive OR tag:spam))) OR '
+            '(folder:"Junk" AND ((NOT tag:spam AND tag:inbox))))')
+
+    def test_other_terms_are_looked_up_once(self):
+        messages = [
+            self._make_message('a', [], 'INBOX/cur/a'),
+            self._make_message('b', [], 'INBOX/cur/b'),
+        ]
+
+        def get_messages(query):
+            if query.endswith(' AND (from:boss)'):
+                return messages[1:]
+            return messages
+        self.mover.db.get_messages.side_effect = get_messages
+
+        moves = self.mover.plan({'INBOX': {'from:boss': 'Work'}})
+
+        self.assertListEqual([move.message_id for move in moves], ['b'])
+        self.assertEqual(self.mover.db.get_messages.call_count, 2)
+
+    def test_summary_only_when_logged(self):
+        message = self._make_message('a', ['spam'], 'INBOX/cur/a')
+        self.mover.db.get_messages.return_value = [message]
+
+        with mock.patch('afew.MailMover.get_message_summary') as get_message_summary:
+            self.mover.plan({'INBOX': {'tag:spam': 'Junk'}})
+            get_message_summary.assert_not_called()
+
+            with self.assertLogs(level='DEBUG'):
+                self.mover.plan({'INBOX': {'tag:spam': 'Junk'}})
+            get_message_summary.assert_called_once_with(message)
+
+
+class TestMovePlan(unittest.TestCase):
+    def test_round_trip(self):
+        from afew.MailMover import Move, read_plan, write_plan
+
+        moves = [Move('a@b', '/mail/INBOX/cur/a', '/mail/Junk/cur/a', 'INBOX', 'tag:spam'),
+                 Move('c@d', '/mail/INBOX/new/c', '/mail/Archive/new/c', 'INBOX', 'tag:"a b"')]
+        plan_file = io.StringIO()
+        write_plan(moves, plan_file)
+        plan_file.seek(0)
+
+        self.assertEqual(json.loads(plan_file.getvalue().splitlines()[0]),
+                         {'message_id': 'a@b', 'source': '/mail/INBOX/cur/a',
+                          'destination': '/mail/Junk/cur/a', 'folder': 'INBOX',
+                          'rule': 'tag:spam'})
+        self.assertListEqual(read_plan(plan_file), moves)
+
+        with self.assertRaises(ValueError):
+            read_plan(io.StringIO('{"source": "/mail/INBOX/cur/a"}\n'))
+
+    def test_apply_plan(self):
+        from afew.MailMover import MailMover, Move
+
+        test_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, test_dir)
+        os.makedirs(os.path.join(test_dir, 'Junk', 'cur'))
+        source = os.path.join(test_dir, 'a')
+        with open(source, 'w') as f:
+            f.write('mail')
+        destination = os.path.join(test_dir, 'Junk', 'cur', 'a')
+        gone = os.path.join(test_dir, 'gone')
+
+        mover = MailMover(journal_path=os.path.join(test_dir, 'journal'))
+        mover.db = mock.Mock()
+        mover.apply_plan([Move('a', source, destination, 'INBOX', 'tag:spam'),
+                          Move('b', gone, destination + 'b', 'INBOX', 'tag:spam')])
+
+        self.assertTrue(os.path.exists(destination))
+        self.assertFalse(os.path.exists(source))
+        mover.db.get_messages.assert_not_called()
+        mover.db.move_messages.assert_called_once_with([(source, [destination])])
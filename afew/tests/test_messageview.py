@@ -0,0 +1,49 @@
+# SPDX-License-Identifier: ISC
+"""Test suite for MessageView.
+"""
+import unittest
+from unittest import mock
+
+from afew.FilterChain import TagChanges
+from afew.MessageView import MessageView
+
+
+def _make_message():
+    message = mock.Mock()
+    message.messageid = 'a'
+    message.tags = {'new'}
+    message.filenames.side_effect = lambda: iter(['/mail/cur/a', '/mail/cur/b'])
+    message.header.side_effect = lambda name: {'subject': 'hi'}[name.lower()]
+    return message
+
+
+class TestMessageView(unittest.TestCase):
+    """Test suite for `MessageView`.
+    """
+    def test_values_are_read_once(self):
+        message = _make_message()
+        view = MessageView(message, {})
+
+        for _ in range(2):
+            self.assertEqual(view.header('Subject'), 'hi')
+            self.assertEqual(view.header('subject'), 'hi')
+            with self.assertRaises(LookupError):
+                view.header('From')
+            self.assertListEqual(list(view.filenames()), ['/mail/cur/a', '/mail/cur/b'])
+
+        self.assertEqual(message.header.call_count, 2)
+        message.filenames.assert_called_once_with()
+
+    def test_pending_changes(self):
+        changes = {}
+        view = MessageView(_make_message(), changes)
+        self.assertSetEqual(view.tags, {'new'})
+
+        changes['a'] = TagChanges()
+        changes['a'].update(False, {'inbox'}, {'new'})
+        self.assertSetEqual(view.tags, {'inbox'})
+
+    def test_slots(self):
+        view = MessageView(_make_message(), {})
+        with self.assertRaises(AttributeError):
+            view.other = 1
@@ -30,3 +30,36 @@ class TestFilterRegistry(unittest.TestCase):
             self.assertEqual('class', FilterRegistry.all_filters['test'])
         finally:
             del FilterRegistry.all_filters['test']
+
+
+class TestGlobalSettings(unittest.TestCase):
+
+    def test_commit_batch_size(self):
+        from afew.Settings import settings, get_commit_batch_size
+        self.addCleanup(settings.remove_option, 'global', 'commit_batch_size')
+
+        settings.set('global', 'commit_batch_size', '0')
+        self.assertEqual(get_commit_batch_size(), 0)
+        settings.set('global', 'commit_batch_size', '100')
+        self.assertEqual(get_commit_batch_size(), 100)
+        settings.set('global', 'commit_batch_size', '-1')
+        with self.assertRaises(ValueError):
+            get_commit_batch_size()
+
+
+class TestNotmuchSettings(unittest.TestCase):
+
+    def test_indexed_headers_keep_case(self):
+        import tempfile
+        from afew.NotmuchSettings import notmuch_settings, notmuch_index_settings, \
+            get_indexed_headers, read_notmuch_settings
+
+        with tempfile.NamedTemporaryFile('w', suffix='.notmuch-config') as config:
+            config.write('[index]\nheader.List = List-Id\n')
+            config.flush()
+            read_notmuch_settings(config.name)
+        self.addCleanup(notmuch_settings.remove_section, 'index')
+        self.addCleanup(notmuch_index_settings.remove_section, 'index')
+
+        self.assertDictEqual(get_indexed_headers(), {'list-id': 'List'})
+        self.assertListEqual(notmuch_settings.options('index'), ['header.list'])
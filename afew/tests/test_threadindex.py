@@ -0,0 +1,158 @@
+# SPDX-License-Identifier: ISC
+"""Test suite for ThreadIndex.
+"""
+import unittest
+from unittest import mock
+
+from afew.FilterChain import FilterChain, TagChanges
+from afew.ThreadIndex import ThreadIndex
+from afew.filters.BaseFilter import Filter
+from afew.filters.KillThreadsFilter import KillThreadsFilter
+from afew.filters.PropagateTagsInThreadFilter import PropagateTagsInThreadFilter
+
+
+def _make_message(message_id, thread_id, tags):
+    message = mock.Mock()
+    message.messageid = message_id
+    message.threadid = thread_id
+    message.tags = set(tags)
+    return message
+
+
+def _make_database(messages):
+    """Make mock database, thread, id and tag queries return the messages of
+    the thread, with the id or with the tag, all other queries return every
+    message.
+    """
+    def get_messages(query):
+        if query.startswith('thread:"'):
+            thread_id = query.split('"')[1]
+            return [message for message in messages if message.threadid == thread_id]
+        if query.startswith('id:"'):
+            message_id = query.split('"')[1]
+            return [message for message in messages if message.messageid == message_id]
+        if query.startswith('tag:"'):
+            tag = query.split('"')[1]
+            return [message for message in messages if tag in message.tags]
+        return list(messages)
+
+    database = mock.Mock()
+    database.get_messages.side_effect = get_messages
+    return database
+
+
+class TestThreadIndex(unittest.TestCase):
+    """Test suite for `ThreadIndex`.
+    """
+    def test_thread_is_loaded_once(self):
+        database = _make_database([
+            _make_message('a', 't1', ['x']),
+            _make_message('b', 't1', ['y', 'spam']),
+            _make_message('c', 't2', ['z']),
+        ])
+        index = ThreadIndex(database)
+
+        self.assertSetEqual(index.tags('t1'), {'x', 'y', 'spam'})
+        self.assertSetEqual(index.tags('t1', 'NOT tag:spam'), {'x'})
+        database.get_messages.assert_called_once_with('thread:"t1"')
+
+    def test_pending_changes(self):
+        database = _make_database([_make_message('a', 't1', ['x'])])
+        changes = {'a': TagChanges()}
+        changes['a'].update(False, {'y'}, {'x'})
+        index = ThreadIndex(database, changes)
+
+        self.assertSetEqual(index.tags('t1'), {'y'})
+
+    def test_threads_with_tag(self):
+        database = _make_database([
+            _make_message('a', 't1', ['killed']),
+            _make_message('b', 't2', ['killed']),
+        ])
+        index = ThreadIndex(database)
+
+        self.assertSetEqual(index.threads_with_tag('killed'), {'t1', 't2'})
+        self.assertSetEqual(index.threads_with_tag('killed'), {'t1', 't2'})
+        database.get_messages.assert_called_once_with('tag:"killed"')
+
+    def test_threads_with_tag_pending_changes(self):
+        database = _make_database([
+            _make_message('a', 't1', ['killed']),
+            _make_message('b', 't2', []),
+        ])
+        changes = {'a': TagChanges(), 'b': TagChanges()}
+        changes['a'].update(False, set(), {'killed'})
+        changes['b'].update(False, {'killed'}, set())
+        index = ThreadIndex(database, changes)
+
+        self.assertSetEqual(index.threads_with_tag('killed'), {'t2'})
+
+
+class TestThreadFilters(unittest.TestCase):
+    """Test the thread filters in a chain.
+    """
+    def test_kill_and_propagate(self):
+        messages = [
+            _make_message('a', 't1', ['killed', 'project']),
+            _make_message('b', 't1', ['new']),
+            _make_message('c', 't2', ['new']),
+        ]
+        database = _make_database(messages)
+        chain = FilterChain(database, [
+            KillThreadsFilter(database),
+            PropagateTagsInThreadFilter(database, propagate_tags='project;other'),
+        ])
+        chain.run('tag:new')
+        chain.commit(dry_run=False)
+
+        database.apply_tag_changes.assert_called_once_with(
+            {'b': (False, {'killed', 'project'}, set())})
+        database.get_messages.assert_any_call('thread:{tag:new}')
+
+    def test_propagate_sees_changes_to_later_messages(self):
+        """A tag added to a message by an earlier filter is propagated to its
+        thread-mates, even those handled before it.
+        """
+        messages = [
+            _make_message('a', 't1', ['new']),
+            _make_message('b', 't1', ['new']),
+        ]
+        database = _make_database(messages)
+        get_messages = database.get_messages.side_effect
+        database.get_messages.side_effect = lambda query: (
+            messages[1:] if 'id:b' in query else get_messages(query))
+        chain = FilterChain(database, [
+            Filter(database, tags=['+important'], query='id:b'),
+            PropagateTagsInThreadFilter(database, propagate_tags='important'),
+        ])
+        chain.run('tag:new')
+        chain.commit(dry_run=False)
+
+        database.apply_tag_changes.assert_called_once_with(
+            {'a': (False, {'important'}, set()), 'b': (False, {'important'}, set())})
+
+    def test_kill_in_same_run(self):
+        """A thread killed by an earlier filter of the same run kills its
+        other messages.
+        """
+        messages = [
+            _make_message('a', 't1', ['new']),
+            _make_message('b', 't1', ['new']),
+            _make_message('c', 't2', ['new']),
+        ]
+        database = _make_database(messages)
+        get_messages = database.get_messages.side_effect
+        database.get_messages.side_effect = lambda query: (
+            messages[:1] if 'id:a' in query else get_messages(query))
+        chain = FilterChain(database, [
+            Filter(database, tags=['+killed'], query='id:a'),
+            KillThreadsFilter(database),
+        ])
+        chain.run('tag:new')
+        chain.commit(dry_run=False)
+
+        database.apply_tag_changes.assert_called_once_with(
+            {'a': (False, {'killed'}, set()), 'b': (False, {'killed'}, set())})
+        # the killed threads are looked up, not the threads of every message
+        self.assertFalse([call for call in database.get_messages.call_args_list
+                          if call[0][0].startswith('thread:{')])